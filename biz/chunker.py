@@ -1,23 +1,98 @@
 """Chunker abstraction and implementations."""
 
+import fnmatch
 import logging
 import os
+import re
+import time
 from abc import ABC, abstractmethod
-from dataclasses import dataclass
-from functools import cached_property
-from typing import Any, Dict, List, Optional
-
-import pygments
+from array import array
+from bisect import bisect_left, bisect_right
+from collections.abc import Sequence
+from functools import lru_cache
+from itertools import accumulate
+from typing import Any, Dict, Generator, List, NamedTuple, Optional, Tuple
+from urllib.parse import quote
+
+import pygments.lexers
+import pygments.util
 import tiktoken
-from semchunk import chunk as chunk_via_semchunk
 from tree_sitter import Node
 from tree_sitter_language_pack import get_parser
 
 logger = logging.getLogger(__name__)
 tokenizer = tiktoken.get_encoding("cl100k_base")
 
+# Token counts answered from a FileTokenIndex are estimates: tokenization is not additive across range boundaries.
+# Ranges whose estimate comes within this many tokens of the limit are re-tokenized exactly.
+TOKEN_ESTIMATE_MARGIN = 16
+
+
+def _separators(*separators: str) -> re.Pattern:
+    """Compiles a byte pattern matching any of the separators, each matched as a whole UTF-8 sequence."""
+    return re.compile(b"|".join(re.escape(separator.encode("utf-8")) for separator in separators))
+
+
+# Separators used by TextFileChunker, from the most to the least desirable place to split text at. They are matched
+# against UTF-8 bytes, so splits never fall inside a multi-byte character.
+TEXT_SPLITTERS = [
+    re.compile(rb"(?:\r?\n[ \t]*){2,}"),  # Blank lines between paragraphs.
+    re.compile(rb"[\r\n]+"),  # Line breaks.
+    re.compile(rb"\t+"),  # Tabs.
+    re.compile(rb"\s+"),  # Any whitespace.
+    _separators(".", "?", "!", "*", "。", "？", "！"),  # Sentence terminators.
+    _separators(";", ",", "(", ")", "[", "]", "'", '"', "`", "；", "，", "、", "（", "）", "“", "”", "‘", "’"),  # Clauses.
+    _separators(":", "—", "…", "：", "/", "\\", "–", "&", "-"),  # Sentence interrupters and word joiners.
+]
+
+# Language detection results and tree-sitter parsers are cached per process, and shared by every chunker in it.
+_language_cache: Dict[str, Optional[str]] = {}
+_parser_pool: Dict[str, Any] = {}
+_cache_stats = {
+    "language_hits": 0,
+    "language_misses": 0,
+    "language_seconds": 0.0,  # Time spent in pygments lookups on cache misses.
+    "parser_hits": 0,
+    "parser_misses": 0,
+}
+
+# Kinds of definitions recorded in a file's symbol table, by a keyword of the tree-sitter node type. Node types are
+# only considered definitions with one of DEFINITION_SUFFIXES, e.g. "function_definition" but not
+# "function_declarator".
+DEFINITION_KINDS = [("constructor", "method"), ("class", "class"), ("struct", "class"), ("interface", "class"),
+                    ("trait", "class"), ("enum", "class"), ("impl", "class"), ("method", "method"),
+                    ("function", "function"), ("const", "constant"), ("type", "type")]
+DEFINITION_SUFFIXES = ("_definition", "_declaration", "_item", "_spec")
+# Module- or class-level variables are recorded as constants when their name is UPPER_CASE.
+CONSTANT_NODE_TYPES = {"assignment", "variable_declarator", "static_item"}
+_IDENTIFIER_RE = re.compile(r"[A-Za-z_$][\w$]*")
+_CONSTANT_NAME_RE = re.compile(r"[A-Z][A-Z0-9_]*")
+
+
+@lru_cache(maxsize=None)
+def _definition_kind(node_type: str) -> Optional[str]:
+    if node_type in CONSTANT_NODE_TYPES:
+        return "constant"
+    if not node_type.endswith(DEFINITION_SUFFIXES):
+        return None
+    return next((kind for keyword, kind in DEFINITION_KINDS if keyword in node_type), None)
+
+
+@lru_cache(maxsize=None)
+def _special_filename_regex() -> re.Pattern:
+    """Matches filenames that pygments recognizes by more than their extension (e.g. Makefile, CMakeLists.txt)."""
+    patterns = []
+    for _, _, filenames, _ in pygments.lexers.get_all_lexers():
+        for pattern in filenames:
+            extension = pattern[2:]
+            if not pattern.startswith("*.") or any(c in extension for c in "*?["):
+                patterns.append(fnmatch.translate(pattern))
+    return re.compile("|".join(patterns))
+
 
 class Chunk:
+    __slots__ = ()
+
     @abstractmethod
     def content(self) -> str:
         """The content of the chunk to be indexed."""
@@ -27,54 +102,83 @@ class Chunk:
         """Metadata for the chunk to be indexed."""
 
 
-@dataclass
-class FileChunk(Chunk):
-    """A chunk of code or text extracted from a file in the repository."""
+class ChunkRange(NamedTuple):
+    """Position and size of a chunk within its file."""
 
-    file_content: str  # The content of the entire file, not just this chunk.
-    file_metadata: Dict  # Metadata of the entire file, not just this chunk.
     start_byte: int
     end_byte: int
+    num_tokens: int
+
+
+class Symbol(NamedTuple):
+    """A definition in a code file: a class, function, method, constant or type."""
+
+    name: str
+    kind: str
+    start_byte: int
+    end_byte: int
+
+
+class FileChunk(Chunk):
+    """A chunk of code or text extracted from a file in the repository.
+
+    This is a lightweight view into a `ChunkedFile`, which holds the file bytes and metadata shared by all of its chunks.
+    The content and metadata are only built when requested, e.g. when a batch is serialized for upload.
+    """
+
+    __slots__ = ("file", "start_byte", "end_byte", "num_tokens")
+
+    def __init__(self, file: "ChunkedFile", start_byte: int, end_byte: int, num_tokens: int):
+        self.file = file
+        self.start_byte = start_byte
+        self.end_byte = end_byte
+        self.num_tokens = num_tokens
 
-    @cached_property
+    @property
     def filename(self):
-        if not "file_path" in self.file_metadata:
-            raise ValueError("file_metadata must contain a 'file_path' key.")
-        return self.file_metadata["file_path"]
+        return self.file.file_metadata["file_path"]
 
-    @cached_property
+    @property
     def content(self) -> Optional[str]:
         """The text content to be embedded. Might contain information beyond just the text snippet from the file."""
         """
         start_byte 和 end_byte 是基于字节流的位置索引。如果需要截取字符串内容，必须先将字符串转换为字节流，完成截取后再将字节流转换回字符串格式。
         直接对字符串进行截取可能会导致中文字符被错误截断，从而出现乱码或错位问题。
         """
-        return self.filename + "\n\n" + self.file_content.encode("utf-8")[self.start_byte: self.end_byte].decode(
-            "utf-8", "ignore")
+        return self.filename + "\n\n" + self.file.file_bytes[self.start_byte: self.end_byte].decode("utf-8", "ignore")
+
+    @property
+    def id(self) -> str:
+        # Some vector stores require the IDs to be ASCII. Percent-encoding keeps the IDs of files whose paths differ
+        # only by non-ASCII characters ("数据.py" and "配置.py") distinct, and leaves plain ASCII paths readable.
+        filename_ascii = quote(self.filename, safe="/")
+        return f"{filename_ascii}_{self.start_byte}_{self.end_byte}"
 
-    @cached_property
+    @property
     def metadata(self):
         """Converts the chunk to a dictionary that can be passed to a vector store."""
-        # Some vector stores require the IDs to be ASCII.
-        filename_ascii = self.filename.encode("ascii", "ignore").decode("ascii")
         chunk_metadata = {
-            # Some vector stores require the IDs to be ASCII.
-            "id": f"{filename_ascii}_{self.start_byte}_{self.end_byte}",
+            # Marqo takes the document ID from "_id". Setting it makes re-indexing a chunk overwrite it, and lets
+            # chunks be deleted by ID.
+            "_id": self.id,
+            "id": self.id,
             "start_byte": self.start_byte,
             "end_byte": self.end_byte,
             "length": self.end_byte - self.start_byte,
             # Note to developer: When choosing a large chunk size, you might exceed the vector store's metadata
-            # size limit. In that case, you can simply store the start/end bytes above, and fetch the content
-            # directly from the repository when needed.
+            # size limit. In that case, index with store_text=False (see `Embedder`): only the start/end bytes
+            # above are stored, and the content is read back from the repository by `RepoSnapshot`.
             "text": self.content,
         }
-        chunk_metadata.update(self.file_metadata)
+        chunk_metadata.update(self.file.file_metadata)
         return chunk_metadata
 
-    @cached_property
-    def num_tokens(self):
-        """Number of tokens in this chunk."""
-        return len(tokenizer.encode(self.content, disallowed_special=()))
+    @property
+    def payload_bytes(self) -> int:
+        """Approximate size of the chunk once serialized for the vector store, computed without building it."""
+        file_metadata_bytes = sum(len(str(key)) + len(str(value)) for key, value in self.file.file_metadata.items())
+        # The filename appears in both the id and the text; the constant covers keys, numbers and JSON syntax.
+        return 2 * len(self.filename) + self.end_byte - self.start_byte + file_metadata_bytes + 128
 
     def __eq__(self, other):
         if isinstance(other, Chunk):
@@ -88,12 +192,96 @@ class FileChunk(Chunk):
     def __hash__(self):
         return hash((self.filename, self.start_byte, self.end_byte))
 
+    def __repr__(self):
+        return f"FileChunk({self.filename!r}, {self.start_byte}, {self.end_byte}, num_tokens={self.num_tokens})"
+
+
+class ChunkedFile(Sequence):
+    """The chunks of a single file.
+
+    The encoded file and its metadata are stored once, and the chunks as parallel arrays of start byte, end byte and
+    token count. Indexing or iterating yields `FileChunk` views.
+    """
+
+    __slots__ = ("file_bytes", "file_metadata", "starts", "ends", "tokens", "symbols")
+
+    def __init__(self, file_bytes: bytes, file_metadata: Dict, ranges: Tuple[array, array, array] = None,
+                 symbols: Optional[List[Symbol]] = None):
+        if not "file_path" in file_metadata:
+            raise ValueError("file_metadata must contain a 'file_path' key.")
+        self.file_bytes = file_bytes
+        self.file_metadata = file_metadata
+        self.starts, self.ends, self.tokens = ranges or (array("q"), array("q"), array("l"))
+        # The definitions in the file, sorted by start byte; empty unless it was parsed as code.
+        self.symbols = symbols or []
+
+    def append(self, chunk_range: ChunkRange):
+        self.starts.append(chunk_range.start_byte)
+        self.ends.append(chunk_range.end_byte)
+        self.tokens.append(chunk_range.num_tokens)
+
+    def ranges(self) -> Tuple[array, array, array]:
+        """The (starts, ends, tokens) arrays, e.g. to send the chunks to another process without the file content."""
+        return self.starts, self.ends, self.tokens
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return FileChunk(self, self.starts[i], self.ends[i], self.tokens[i])
+
+
+@lru_cache(maxsize=None)
+def _token_length(token: int) -> int:
+    """Length in bytes of a token; bounded by the size of the vocabulary."""
+    return len(tokenizer.decode_single_token_bytes(token))
+
+
+class FileTokenIndex:
+    """Tokenizes a file once and answers token counts for byte ranges of it.
+
+    Chunk contents are prefixed with the filename (see `FileChunk.content`), so the header tokens are included in
+    every count.
+    """
+
+    def __init__(self, file_content: str, filename: str):
+        self.file_bytes = file_content.encode("utf-8")
+        self.header = filename + "\n\n"
+        self.header_tokens = len(tokenizer.encode(self.header, disallowed_special=()))
+
+        tokens = tokenizer.encode(file_content, disallowed_special=())
+        # token_offsets[i] is the byte offset where the i-th token starts; the last entry is the file size. Only the
+        # offsets are kept: the bytes of each token aren't materialized, their lengths are looked up by token.
+        self.token_offsets = array("q", accumulate(map(_token_length, tokens), initial=0))
+
+    def estimate(self, start_byte: int, end_byte: int) -> int:
+        """Number of file tokens overlapping [start_byte, end_byte), plus the header tokens."""
+        if end_byte <= start_byte:
+            return self.header_tokens
+        first = bisect_right(self.token_offsets, start_byte) - 1
+        last = bisect_left(self.token_offsets, end_byte)
+        return self.header_tokens + last - first
+
+    def exact(self, start_byte: int, end_byte: int) -> int:
+        """Number of tokens of the chunk content, obtained by re-tokenizing it."""
+        text = self.header + self.file_bytes[start_byte:end_byte].decode("utf-8", "ignore")
+        return len(tokenizer.encode(text, disallowed_special=()))
+
+    def count(self, start_byte: int, end_byte: int, max_tokens: int) -> int:
+        """Token count that is exact whenever it matters for the `max_tokens` limit."""
+        estimate = self.estimate(start_byte, end_byte)
+        if abs(estimate - max_tokens) < TOKEN_ESTIMATE_MARGIN:
+            return self.exact(start_byte, end_byte)
+        return estimate
+
 
 class Chunker(ABC):
     """Abstract class for chunking a datum into smaller pieces."""
 
     @abstractmethod
-    def chunk(self, content: Any, metadata: Dict) -> List[Chunk]:
+    def chunk(self, content: Any, metadata: Dict) -> Sequence[Chunk]:
         """Chunks a datum into smaller pieces."""
 
 
@@ -108,32 +296,75 @@ class CodeFileChunker(Chunker):
     def _get_language_from_filename(filename: str):
         """Returns a canonical name for the language of the file, based on its extension.
         Returns None if the language is unknown to the pygments lexer.
+
+        Results are cached by extension, or by file name for names that pygments matches specially.
         """
+        basename = os.path.basename(filename)
+        extension = os.path.splitext(basename)[1]
+        cache_key = extension if extension and not _special_filename_regex().match(basename) else basename
+        if cache_key in _language_cache:
+            _cache_stats["language_hits"] += 1
+            return _language_cache[cache_key]
+
+        _cache_stats["language_misses"] += 1
+        start = time.perf_counter()
         # pygments doesn't recognize .tsx files and returns None. So we need to special-case them.
-        extension = os.path.splitext(filename)[1]
         if extension == ".tsx":
-            return "tsx"
+            language = "tsx"
+        else:
+            try:
+                lexer = pygments.lexers.get_lexer_for_filename(basename)
+                language = lexer.name.lower()
+            except pygments.util.ClassNotFound:
+                language = None
+        _cache_stats["language_seconds"] += time.perf_counter() - start
 
-        try:
-            lexer = pygments.lexers.get_lexer_for_filename(filename)
-            return lexer.name.lower()
-        except pygments.util.ClassNotFound:
-            return None
+        _language_cache[cache_key] = language
+        return language
 
-    def _chunk_node(self, node: Node, file_content: str, file_metadata: Dict) -> List[FileChunk]:
+    @staticmethod
+    def _get_parser(language: str):
+        """Returns the tree-sitter parser for the language from the process-wide pool.
+
+        Raises LookupError if tree-sitter doesn't support the language.
+        """
+        if language in _parser_pool:
+            _cache_stats["parser_hits"] += 1
+            parser = _parser_pool[language]
+        else:
+            _cache_stats["parser_misses"] += 1
+            try:
+                parser = get_parser(language)
+            except LookupError:
+                parser = None
+            _parser_pool[language] = parser
+
+        if parser is None:
+            raise LookupError(f"No tree-sitter parser for {language}.")
+        return parser
+
+    @staticmethod
+    def cache_stats() -> Dict:
+        """Hit/miss counts of the language detection cache and the parser pool in this process."""
+        return dict(_cache_stats)
+
+    def _new_range(self, token_index: FileTokenIndex, start_byte: int, end_byte: int) -> ChunkRange:
+        return ChunkRange(start_byte, end_byte, token_index.count(start_byte, end_byte, self.max_tokens))
+
+    def _chunk_node(self, node: Node, token_index: FileTokenIndex) -> List[ChunkRange]:
         """Splits a node in the parse tree into a flat list of chunks."""
-        node_chunk = FileChunk(file_content, file_metadata, node.start_byte, node.end_byte)
+        node_chunk = self._new_range(token_index, node.start_byte, node.end_byte)
 
         if node_chunk.num_tokens <= self.max_tokens:
             return [node_chunk]
 
         if not node.children:
             # This is a leaf node, but it's too long. We'll have to split it with a text tokenizer.
-            return self.text_chunker.chunk(file_content[node.start_byte: node.end_byte], file_metadata)
+            return list(self.text_chunker.chunk_ranges(token_index, node.start_byte, node.end_byte))
 
         chunks = []
         for child in node.children:
-            chunks.extend(self._chunk_node(child, file_content, file_metadata))
+            chunks.extend(self._chunk_node(child, token_index))
 
         for chunk in chunks:
             # This should always be true. Otherwise there must be a bug in the code.
@@ -147,13 +378,9 @@ class CodeFileChunker(Chunker):
                 merged_chunks.append(chunk)
             elif merged_chunks[-1].num_tokens + chunk.num_tokens < self.max_tokens - 50:
                 # There's a good chance that merging these two chunks will be under the token limit. We're not 100% sure
-                # at this point, because tokenization is not necessarily additive.
-                merged = FileChunk(
-                    file_content,
-                    file_metadata,
-                    merged_chunks[-1].start_byte,
-                    chunk.end_byte,
-                )
+                # at this point, because tokenization is not necessarily additive. The token index only re-tokenizes
+                # the merged chunk when it gets close to max_tokens.
+                merged = self._new_range(token_index, merged_chunks[-1].start_byte, chunk.end_byte)
                 if merged.num_tokens <= self.max_tokens:
                     merged_chunks[-1] = merged
                 else:
@@ -168,6 +395,44 @@ class CodeFileChunker(Chunker):
 
         return merged_chunks
 
+    @staticmethod
+    def _symbols(root: Node, file_bytes: bytes) -> List[Symbol]:
+        """Extracts the definitions of a parse tree, in file order.
+
+        Function bodies aren't searched: local definitions aren't worth looking up, and skipping them keeps this cheap.
+        Functions defined inside a class are recorded as methods.
+        """
+        symbols = []
+        # (node, whether it's inside a class)
+        stack = [(child, False) for child in reversed(root.children)]
+        while stack:
+            node, in_class = stack.pop()
+            kind = _definition_kind(node.type)
+            if kind is not None:
+                name_node = node.child_by_field_name("name") or node.child_by_field_name("left")
+                if name_node is None:
+                    # C and C++ functions are named by their innermost declarator.
+                    name_node = node.child_by_field_name("declarator")
+                    while name_node is not None and name_node.child_by_field_name("declarator") is not None:
+                        name_node = name_node.child_by_field_name("declarator")
+                name = file_bytes[name_node.start_byte: name_node.end_byte].decode("utf-8", errors="ignore") \
+                    if name_node is not None else ""
+                value = node.child_by_field_name("value") if kind == "constant" else None
+                if value is not None and value.type in ("arrow_function", "function", "function_expression"):
+                    # const loadConfig = () => {...}
+                    kind = "function"
+                if kind == "function" and in_class:
+                    kind = "method"
+                if _IDENTIFIER_RE.fullmatch(name) and (node.type not in CONSTANT_NODE_TYPES or kind == "function"
+                                                       or _CONSTANT_NAME_RE.fullmatch(name)):
+                    symbols.append(Symbol(name, kind, node.start_byte, node.end_byte))
+                if kind in ("function", "method") or (kind == "constant" and name_node is not None):
+                    continue
+                in_class = in_class or kind == "class"
+            stack.extend((child, in_class) for child in reversed(node.children))
+        symbols.sort(key=lambda symbol: symbol.start_byte)
+        return symbols
+
     @staticmethod
     def is_code_file(filename: str) -> bool:
         """Checks whether pygment & tree_sitter can parse the file as code."""
@@ -184,7 +449,7 @@ class CodeFileChunker(Chunker):
             return None
 
         try:
-            parser = get_parser(language)
+            parser = CodeFileChunker._get_parser(language)
         except LookupError:
             logging.debug("%s doesn't seem to be a code file.", filename)
             return None
@@ -200,7 +465,7 @@ class CodeFileChunker(Chunker):
             return None
         return tree
 
-    def chunk(self, content: Any, metadata: Dict) -> List[Chunk]:
+    def chunk(self, content: Any, metadata: Dict) -> Sequence[Chunk]:
         """Chunks a code file into smaller pieces."""
         file_content = content
         file_metadata = metadata
@@ -213,49 +478,105 @@ class CodeFileChunker(Chunker):
         if tree is None:
             return []
 
-        file_chunks = self._chunk_node(tree.root_node, file_content, file_metadata)
-        for chunk in file_chunks:
+        token_index = FileTokenIndex(file_content, file_path)
+        file_chunks = ChunkedFile(token_index.file_bytes, file_metadata,
+                                  symbols=self._symbols(tree.root_node, token_index.file_bytes))
+        for chunk in self._chunk_node(tree.root_node, token_index):
             # Make sure that the chunk has content and doesn't exceed the max_tokens limit. Otherwise there must be
             # a bug in the code.
             assert (
                     chunk.num_tokens <= self.max_tokens
             ), f"Chunk size {chunk.num_tokens} exceeds max_tokens {self.max_tokens}."
+            file_chunks.append(chunk)
 
         return file_chunks
 
 
 class TextFileChunker(Chunker):
-    """Wrapper around semchunk: https://github.com/umarbutler/semchunk."""
+    """Splits text at the most desirable separators in TEXT_SPLITTERS, in the spirit of semchunk
+    (https://github.com/umarbutler/semchunk), but working on byte offsets directly.
+
+    Splits are produced lazily as (start_byte, end_byte) ranges and merged greedily, so large files are never held as a
+    list of intermediate strings, and chunk positions don't have to be searched for in the file afterwards.
+    """
 
     def __init__(self, max_tokens: int):
         self.max_tokens = max_tokens
-        self.count_tokens = lambda text: len(tokenizer.encode(text, disallowed_special=()))
 
-    def chunk(self, content: Any, metadata: Dict) -> List[Chunk]:
+    @staticmethod
+    def _split_pieces(token_index: FileTokenIndex, start_byte: int, end_byte: int,
+                      level: int) -> Generator[Tuple[int, int], None, None]:
+        """Yields consecutive ranges covering [start_byte, end_byte), split after each separator of the given level.
+
+        Past the last level of TEXT_SPLITTERS, the range is split at token boundaries that are also character
+        boundaries.
+        """
+        position = start_byte
+        if level < len(TEXT_SPLITTERS):
+            boundaries = (match.end() for match in TEXT_SPLITTERS[level].finditer(token_index.file_bytes, start_byte,
+                                                                                 end_byte))
+        else:
+            offsets = token_index.token_offsets
+            boundaries = (
+                offsets[i]
+                for i in range(bisect_right(offsets, start_byte), bisect_left(offsets, end_byte))
+                # Skip boundaries that fall on a UTF-8 continuation byte, i.e. inside a character.
+                if token_index.file_bytes[offsets[i]] & 0xC0 != 0x80
+            )
+        for boundary in boundaries:
+            if position < boundary < end_byte:
+                yield position, boundary
+                position = boundary
+        if position < end_byte:
+            yield position, end_byte
+
+    def _split(self, token_index: FileTokenIndex, start_byte: int, end_byte: int,
+               level: int) -> Generator[Tuple[int, int, int], None, None]:
+        """Yields (start_byte, end_byte, num_tokens) chunks covering [start_byte, end_byte), each within max_tokens."""
+        chunk_start = chunk_end = chunk_tokens = None
+        for piece_start, piece_end in self._split_pieces(token_index, start_byte, end_byte, level):
+            if chunk_start is not None:
+                merged_tokens = token_index.count(chunk_start, piece_end, self.max_tokens)
+                if merged_tokens <= self.max_tokens:
+                    chunk_end, chunk_tokens = piece_end, merged_tokens
+                    continue
+                yield chunk_start, chunk_end, chunk_tokens
+                chunk_start = None
+
+            piece_tokens = token_index.count(piece_start, piece_end, self.max_tokens)
+            if piece_tokens <= self.max_tokens:
+                chunk_start, chunk_end, chunk_tokens = piece_start, piece_end, piece_tokens
+            elif level < len(TEXT_SPLITTERS):
+                yield from self._split(token_index, piece_start, piece_end, level + 1)
+            else:
+                # A single token that doesn't fit on its own. There is nothing left to split.
+                yield piece_start, piece_end, piece_tokens
+
+        if chunk_start is not None:
+            yield chunk_start, chunk_end, chunk_tokens
+
+    def chunk_ranges(self, token_index: FileTokenIndex, start_byte: int,
+                     end_byte: int) -> Generator[ChunkRange, None, None]:
+        """Yields the chunks of [start_byte, end_byte) of the indexed file. Chunks that contain only whitespace are
+        skipped.
+        """
+        for chunk_start, chunk_end, num_tokens in self._split(token_index, start_byte, end_byte, level=0):
+            if token_index.file_bytes[chunk_start:chunk_end].strip():
+                yield ChunkRange(chunk_start, chunk_end, num_tokens)
+
+    def chunk(self, content: Any, metadata: Dict) -> Sequence[Chunk]:
         """Chunks a text file into smaller pieces."""
         file_content = content
         file_metadata = metadata
         file_path = file_metadata["file_path"]
 
-        # We need to allocate some tokens for the filename, which is part of the chunk content.
-        extra_tokens = self.count_tokens(file_path + "\n\n")
-        text_chunks = chunk_via_semchunk(file_content, self.max_tokens - extra_tokens, self.count_tokens)
-
-        file_chunks = []
-        start = 0
-        for text_chunk in text_chunks:
+        # The token index accounts for the filename, which is part of the chunk content.
+        token_index = FileTokenIndex(file_content, file_path)
+        file_chunks = ChunkedFile(token_index.file_bytes, file_metadata)
+        for chunk in self.chunk_ranges(token_index, 0, len(token_index.file_bytes)):
             # This assertion should always be true. Otherwise there's a bug worth finding.
-            assert self.count_tokens(text_chunk) <= self.max_tokens - extra_tokens
-
-            # Find the start/end positions of the chunks.
-            start = file_content.index(text_chunk, start)
-            if start == -1:
-                logging.warning("Couldn't find semchunk in content: %s", text_chunk)
-            else:
-                end = start + len(text_chunk)
-                file_chunks.append(FileChunk(file_content, file_metadata, start, end))
-
-            start = end
+            assert chunk.num_tokens <= self.max_tokens
+            file_chunks.append(chunk)
 
         return file_chunks
 
@@ -268,7 +589,7 @@ class UniversalFileChunker(Chunker):
         self.code_chunker = CodeFileChunker(max_tokens)
         self.text_chunker = TextFileChunker(max_tokens)
 
-    def chunk(self, content: Any, metadata: Dict) -> List[Chunk]:
+    def chunk(self, content: Any, metadata: Dict) -> Sequence[Chunk]:
         if not "file_path" in metadata:
             raise ValueError("metadata must contain a 'file_path' key.")
         file_path = metadata["file_path"]
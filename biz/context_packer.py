@@ -0,0 +1,119 @@
+"""Packs retrieved chunks into the context of a chat prompt, within a token budget."""
+
+from typing import Dict, List, Optional, Tuple
+
+from biz.chunker import tokenizer
+from biz.repo_snapshot import RepoSnapshot
+from biz.vector_store import Document
+
+
+class ContextPacker:
+    """Turns search results into as few prompt tokens as possible.
+
+    Duplicate chunks are dropped, and chunks of the same file whose byte ranges overlap or are at most `max_gap_bytes`
+    apart are merged into one excerpt, so their shared file header and formatting are only sent once. Excerpts are then
+    added in relevance order (the rank of their best chunk) as long as they fit in `max_tokens`, counted with the
+    chunker's tiktoken encoding.
+
+    Chunkers leave the whitespace between consecutive chunks out of both, so neighbouring chunks rarely touch. The gap
+    between merged chunks is read from the repository snapshot when the chunks record their commit; otherwise (or if
+    it can't be read) the chunks are joined with a newline.
+    """
+
+    def __init__(self, max_tokens: int = 3000, encoding=None, snapshot: Optional[RepoSnapshot] = None,
+                 max_gap_bytes: int = 256):
+        self.max_tokens = max_tokens
+        self.encoding = encoding or tokenizer
+        self.snapshot = snapshot
+        self.max_gap_bytes = max_gap_bytes
+
+    @staticmethod
+    def _span(doc: Document) -> Optional[Tuple[int, int, bytes]]:
+        """The (start_byte, end_byte, file bytes) of a chunk, or None if its content can't be mapped to that range."""
+        metadata = doc.metadata
+        header = f"{metadata.get('file_path')}\n\n"
+        if "start_byte" not in metadata or not doc.page_content.startswith(header):
+            return None
+        body = doc.page_content[len(header):].encode("utf-8")
+        # Content decoded from a range that cuts a character doesn't map back to the range; leave it as is.
+        if len(body) != metadata["end_byte"] - metadata["start_byte"]:
+            return None
+        return metadata["start_byte"], metadata["end_byte"], body
+
+    def _gap(self, metadata: Dict, start_byte: int, end_byte: int) -> bytes:
+        """The bytes of a file between two chunks, or a newline if they can't be read."""
+        if self.snapshot is not None and metadata.get("commit"):
+            data = self.snapshot.read(metadata["file_path"], metadata["commit"], start_byte, end_byte)
+            if data is not None and len(data) == end_byte - start_byte:
+                return data
+        return b"\n"
+
+    def merge(self, documents: List[Document]) -> List[Document]:
+        """Drops duplicates and merges overlapping or neighbouring chunks of the same file, keeping the relevance
+        order."""
+        # (rank, document), where rank is the best rank of the chunks in the document.
+        ranked = []
+        # (index, file, commit) -> [(start_byte, end_byte, body, rank, document)]
+        spans: Dict[Tuple, List[Tuple[int, int, bytes, int, Document]]] = {}
+        seen = set()
+        for rank, doc in enumerate(documents):
+            key = (doc.metadata.get("_index"), doc.metadata.get("file_path"), doc.page_content)
+            if key in seen:
+                continue
+            seen.add(key)
+            span = self._span(doc)
+            if span is None:
+                ranked.append((rank, doc))
+                continue
+            file_key = (doc.metadata.get("_index"), doc.metadata["file_path"], doc.metadata.get("commit"))
+            spans.setdefault(file_key, []).append((*span, rank, doc))
+
+        for file_spans in spans.values():
+            file_spans.sort(key=lambda span: span[0])
+            merged = [list(file_spans[0])]
+            for start, end, body, rank, doc in file_spans[1:]:
+                last = merged[-1]
+                if start - last[1] > self.max_gap_bytes:
+                    merged.append([start, end, body, rank, doc])
+                    continue
+                if start > last[1]:
+                    last[2] += self._gap(doc.metadata, last[1], start) + body
+                    last[1] = end
+                elif end > last[1]:
+                    last[2] += body[last[1] - start:]
+                    last[1] = end
+                if rank < last[3]:
+                    last[3], last[4] = rank, doc
+            for start, end, body, rank, doc in merged:
+                if (start, end) != (doc.metadata["start_byte"], doc.metadata["end_byte"]):
+                    metadata = dict(doc.metadata, start_byte=start, end_byte=end)
+                    content = f"{metadata['file_path']}\n\n{body.decode('utf-8', errors='ignore')}"
+                    doc = Document(page_content=content, metadata=metadata)
+                ranked.append((rank, doc))
+
+        ranked.sort(key=lambda item: item[0])
+        return [doc for _, doc in ranked]
+
+    @staticmethod
+    def format_document(doc: Document) -> str:
+        """A chunk as it appears in the prompt: its file path, then its code in a fenced block."""
+        file_path = doc.metadata.get("file_path")
+        header = f"{file_path}\n\n"
+        if file_path and doc.page_content.startswith(header):
+            return f"{file_path}\n```\n{doc.page_content[len(header):]}\n```"
+        return f"```\n{doc.page_content}\n```"
+
+    def pack(self, documents: List[Document]) -> List[Document]:
+        """The merged documents that fit in the token budget, most relevant first."""
+        packed = []
+        used_tokens = 0
+        for doc in self.merge(documents):
+            tokens = len(self.encoding.encode(self.format_document(doc), disallowed_special=()))
+            # A large excerpt that doesn't fit may leave room for a smaller, less relevant one.
+            if used_tokens + tokens <= self.max_tokens:
+                packed.append(doc)
+                used_tokens += tokens
+        return packed
+
+    def format(self, documents: List[Document]) -> str:
+        return "\n\n".join(self.format_document(doc) for doc in documents)
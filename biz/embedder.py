@@ -1,43 +1,424 @@
+import multiprocessing
+import multiprocessing.util
+import random
+import threading
+import time
 from abc import ABC
+from array import array
+from bisect import bisect_left
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Generator, List, Optional, Sequence, Set, Tuple
+
 from biz.util.log import logger
-import marqo
 
-from biz.chunker import Chunker
+from biz.chunker import Chunk, ChunkedFile, Chunker, CodeFileChunker, FileChunk, Symbol
+from biz.embedding_cache import EmbeddingCache
+from biz.lexical_index import LexicalIndex
 from biz.repo_manager import RepositoryManager
+from biz.vector.backend.base import BackendError, BaseBackend
+
+# HTTP statuses worth retrying; other client errors are caused by the documents themselves.
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+# Approximate bytes per dimension of a vector serialized as JSON, for batches uploaded with their vectors.
+VECTOR_BYTES_PER_DIMENSION = 8
+# Vector dimension assumed until the first vectors are embedded; at least that of the models in use.
+DEFAULT_VECTOR_DIMENSION = 1024
+
+# Per-process state of the chunking workers, set once by `_init_chunk_worker` when the pool starts.
+_worker_repo_manager = None
+_worker_chunker = None
+
+
+def _log_chunker_cache_stats():
+    stats = CodeFileChunker.cache_stats()
+    logger.info("Language detection cache: %d hits, %d misses (%.3fs in lookups). Parser pool: %d hits, %d misses.",
+                stats["language_hits"], stats["language_misses"], stats["language_seconds"],
+                stats["parser_hits"], stats["parser_misses"])
+
+
+def _init_chunk_worker(repo_manager: RepositoryManager, chunker: Chunker):
+    global _worker_repo_manager, _worker_chunker
+    _worker_repo_manager = repo_manager
+    _worker_chunker = chunker
+    # Each worker has its own caches, so it reports them when it exits.
+    multiprocessing.util.Finalize(None, _log_chunker_cache_stats, exitpriority=10)
+
+
+def _read(repo_manager: RepositoryManager, file_path: str) -> Optional[str]:
+    """The content of a file, or None if it can't be read or decoded."""
+    try:
+        return repo_manager.read_file(file_path)
+    except OSError as e:
+        logger.warning("Unable to read file %s: %s", file_path, e)
+        return None
+
+
+def _read_and_chunk(repo_manager: RepositoryManager, chunker: Chunker, metadata: Dict) -> Sequence[Chunk]:
+    """Reads and chunks one file. Empty and unreadable files have no chunks."""
+    content = _read(repo_manager, metadata["file_path"])
+    if not content:
+        return []
+    return chunker.chunk(content, metadata)
+
+
+def _chunk_file(metadata: Dict) -> Tuple[Dict, Optional[Tuple[array, array, array]], List[Symbol]]:
+    """Chunks one file inside a worker process.
+
+    Only the (starts, ends, tokens) arrays of the chunks and the symbols of the file are sent back: the parent reads
+    the file itself rather than receiving a copy of it through the pool's pipe.
+    """
+    chunks = _read_and_chunk(_worker_repo_manager, _worker_chunker, metadata)
+    if not chunks:
+        return metadata, None, []
+    return metadata, chunks.ranges(), chunks.symbols
+
+
+class IngestStats:
+    """Counters and timings of the chunking and upload stages of an ingestion run."""
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.files = 0
+        self.chunks = 0
+        self.chunk_seconds = 0.0  # Time the ingestion loop spent waiting for chunked files.
+        self.documents = 0
+        self.batches = 0
+        self.upload_seconds = 0.0  # Summed over upload workers, so it can exceed the wall time.
+        self.retries = 0
+        self.failed_documents = 0
+        self.backpressure_seconds = 0.0  # Time chunking was paused because too many batches were in flight.
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.embed_seconds = 0.0  # Time spent computing the embeddings of cache misses.
+        self._lock = threading.Lock()
+
+    def add_upload(self, documents: int, failed_documents: int, seconds: float):
+        with self._lock:
+            self.documents += documents
+            self.failed_documents += failed_documents
+            self.batches += 1
+            self.upload_seconds += seconds
+
+    def add_embeddings(self, hits: int, misses: int, seconds: float):
+        with self._lock:
+            self.cache_hits += hits
+            self.cache_misses += misses
+            self.embed_seconds += seconds
+
+    def add_retry(self):
+        with self._lock:
+            self.retries += 1
+
+    def report(self):
+        wall_seconds = time.perf_counter() - self.started_at
+        logger.info("Chunking: %d files, %d chunks in %.1fs (%.1f files/s, %.1f chunks/s).",
+                    self.files, self.chunks, self.chunk_seconds,
+                    self.files / max(self.chunk_seconds, 1e-9), self.chunks / max(self.chunk_seconds, 1e-9))
+        logger.info("Upload: %d documents in %d batches, %.1fs busy (%.1f documents/s), %d retries, %d rejected.",
+                    self.documents, self.batches, self.upload_seconds,
+                    self.documents / max(wall_seconds, 1e-9), self.retries, self.failed_documents)
+        lookups = self.cache_hits + self.cache_misses
+        if lookups:
+            logger.info("Embedding cache: %d hits, %d misses (%.1f%% hit rate), %.1fs embedding misses.",
+                        self.cache_hits, self.cache_misses, 100 * self.cache_hits / lookups, self.embed_seconds)
+        logger.info("Ingestion took %.1fs, of which %.1fs chunking was paused by backpressure.",
+                    wall_seconds, self.backpressure_seconds)
 
 
 class Embedder(ABC):
-    def __init__(self, repo_manager: RepositoryManager, chunker: Chunker, index_name: str, url: str,
-                 model="hf/e5-base-v2"):
+    def __init__(self, repo_manager: RepositoryManager, chunker: Chunker, index_name: str, backend: BaseBackend,
+                 model="hf/e5-base-v2", chunk_workers: int = 1, upload_workers: int = 1,
+                 max_batch_documents: int = 64, max_batch_bytes: int = 2 * 1024 * 1024, max_batch_tokens: int = 32000,
+                 max_retries: int = 4, retry_backoff: float = 1.0, embedding_cache: Optional[EmbeddingCache] = None,
+                 store_text: bool = True, lexical_index: Optional[LexicalIndex] = None):
+        """
+        Args:
+            max_batch_documents, max_batch_bytes, max_batch_tokens: A batch is sent as soon as adding the next chunk
+                would exceed any of these limits. Bytes are the approximate serialized size of the documents.
+            backend: The vector store backend holding the index (see `biz.vector.factory.BackendFactory`).
+            max_retries: How many times a batch is retried when the vector store is unavailable or overloaded.
+            retry_backoff: Delay before the first retry in seconds; it doubles on each further attempt.
+            embedding_cache: When set, chunks are embedded through the index's model before upload and their vectors
+                are cached, so that identical chunks are never embedded twice. Chunks are then uploaded with their
+                vector, as a single custom vector field.
+            store_text: When False, the index only stores the vector and the position of each chunk (file path, byte
+                range and commit), and its text is read back from the local clone at search time (see `RepoSnapshot`).
+                Chunks are then always embedded before upload, through the cache if there is one.
+            lexical_index: When set, chunks are also added to this keyword index, under the same index name and with
+                the same metadata as in the vector store, for hybrid search (see `VectorStore`), along with the symbols
+                defined in code files, for definition lookups.
+        """
         self.repo_manager = repo_manager
         self.chunker = chunker
-        self.client = marqo.Client(url=url)
-        self.index = self.client.index(index_name)
+        self.chunk_workers = chunk_workers
+        self.upload_workers = max(upload_workers, 1)
+        self.max_batch_documents = max_batch_documents
+        self.max_batch_bytes = max_batch_bytes
+        self.max_batch_tokens = max_batch_tokens
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.model = model
+        self.embedding_cache = embedding_cache
+        self.store_text = store_text
+        self.lexical_index = lexical_index
+        # The commit recorded with position-only chunks; set when the dataset is embedded.
+        self.commit = None
+        # Dimension of the embedded vectors, known once the first batch is embedded.
+        self._vector_dimension = None
+        self.backend = backend
+        self.index_name = index_name
+
+        if not self.backend.index_exists(index_name):
+            self.backend.create_index(index_name, model=model)
+
+    def _chunk_files(self,
+                     file_paths: Optional[Set[str]] = None) -> Generator[Tuple[Dict, Sequence[Chunk]], None, None]:
+        """Yields the metadata and chunks of each file in the repository, in walk order, including files without any
+        chunk (e.g. empty or unreadable files)."""
+        walk = self.repo_manager.walk(get_content=False, only_paths=file_paths)
+        if self.chunk_workers <= 1:
+            for metadata in walk:
+                yield metadata, _read_and_chunk(self.repo_manager, self.chunker, metadata)
+            _log_chunker_cache_stats()
+            return
+
+        # Workers are forked so they inherit the loaded tokenizer and don't re-run the calling script.
+        context = multiprocessing.get_context("fork")
+        pool = context.Pool(self.chunk_workers, initializer=_init_chunk_worker,
+                            initargs=(self.repo_manager, self.chunker))
+        try:
+            # imap keeps the walk order, so the output doesn't depend on the number of workers.
+            for metadata, ranges, symbols in pool.imap(_chunk_file, walk, chunksize=8):
+                if ranges is None:
+                    yield metadata, []
+                    continue
+                # Read the same way as in the worker, so the byte ranges computed there match.
+                content = _read(self.repo_manager, metadata["file_path"])
+                if not content:
+                    yield metadata, []
+                    continue
+                yield metadata, ChunkedFile(content.encode("utf-8"), metadata, ranges, symbols)
+            # Let the workers exit normally, so that they report their cache stats.
+            pool.close()
+            pool.join()
+        finally:
+            pool.terminate()
+
+    def _add_documents(self, batch: List[Chunk], stats: IngestStats) -> List[str]:
+        """Sends a batch to the index, retrying transient failures with exponential backoff.
+
+        A batch that the vector store rejects as a whole is split in halves that are sent separately, until the offending
+        documents are isolated. Rejected documents are logged and skipped. Returns the IDs of the rejected documents.
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                if self.embedding_cache is None and self.store_text:
+                    response = self.backend.add_documents(self.index_name, [chunk.metadata for chunk in batch],
+                                                          tensor_fields=["text"])
+                else:
+                    response = self.backend.add_documents(self.index_name, self._documents_with_vectors(batch, stats),
+                                                          tensor_fields=["text"],
+                                                          mappings={"text": {"type": "custom_vector"}})
+                break
+            except BackendError as e:
+                retryable = e.status_code is None or e.status_code in RETRYABLE_STATUS_CODES
+                if retryable and attempt < self.max_retries:
+                    delay = self.retry_backoff * 2 ** attempt
+                    logger.warning("Indexing %d chunks failed (%s), retrying in %.1fs...", len(batch), e, delay)
+                    stats.add_retry()
+                    time.sleep(delay + random.uniform(0, self.retry_backoff))
+                    continue
+                if retryable:
+                    # The vector store is unavailable; splitting the batch wouldn't help.
+                    raise
+                if len(batch) == 1:
+                    logger.error("Skipping chunk %s rejected by the index: %s", batch[0].id, e)
+                    return [batch[0].id]
+                middle = len(batch) // 2
+                return self._add_documents(batch[:middle], stats) + self._add_documents(batch[middle:], stats)
+
+        # The vector store reports documents it couldn't index one by one, without failing the rest of the batch.
+        rejected = []
+        if response.get("errors"):
+            for item in response.get("items", []):
+                if item.get("status", 200) >= 400:
+                    logger.error("Skipping chunk %s rejected by the index: %s", item.get("_id"), item.get("message"))
+                    rejected.append(item.get("_id"))
+        return rejected
+
+    def _embed(self, texts: List[str], stats: IngestStats) -> List[List[float]]:
+        """Embeds texts, computing only the vectors missing from the cache.
+
+        Misses are embedded by the index itself, so they get the same model and document prefix as the index would apply.
+        """
+        if self.embedding_cache is not None:
+            vectors = self.embedding_cache.get_many(self.model, texts)
+        else:
+            vectors = [None] * len(texts)
+        misses = [i for i, vector in enumerate(vectors) if vector is None]
+        start = time.perf_counter()
+        if misses:
+            miss_texts = [texts[i] for i in misses]
+            embeddings = self.backend.embed(self.index_name, miss_texts, content_type="document")
+            if self.embedding_cache is not None:
+                self.embedding_cache.put_many(self.model, miss_texts, embeddings)
+            for i, embedding in zip(misses, embeddings):
+                vectors[i] = embedding
+        if vectors:
+            self._vector_dimension = len(vectors[0])
+        if self.embedding_cache is not None:
+            stats.add_embeddings(len(texts) - len(misses), len(misses), time.perf_counter() - start)
+        return vectors
+
+    def _documents_with_vectors(self, batch: List[Chunk], stats: IngestStats) -> List[Dict]:
+        """Builds the documents of a batch with their vectors in the custom vector field "text"."""
+        documents = [chunk.metadata for chunk in batch]
+        texts = [document["text"] for document in documents]
+        for document, text, vector in zip(documents, texts, self._embed(texts, stats)):
+            if self.store_text:
+                document["text"] = {"vector": vector, "content": text}
+                continue
+            # Only what's needed to find the chunk again in the repository.
+            del document["id"], document["length"]
+            document["text"] = {"vector": vector}
+            document["commit"] = self.commit
+        return documents
 
-        all_index_names = [result["indexName"] for result in self.client.get_indexes()["results"]]
-        if not index_name in all_index_names:
-            self.client.create_index(index_name, model=model)
+    def _add_lexical_documents(self, batch: List[Chunk]):
+        """Adds a batch to the keyword index, with its text only if the vector store has it too, and the symbols
+        defined in each chunk (those starting in it)."""
+        documents = [chunk.metadata for chunk in batch]
+        texts = [document["text"] for document in documents]
+        if not self.store_text:
+            for document in documents:
+                del document["id"], document["length"]
+                document["text"] = ""
+                document["commit"] = self.commit
+        symbols = []
+        # Start bytes of the symbols of each file in the batch.
+        file_starts = {}
+        for chunk in batch:
+            file_symbols = chunk.file.symbols if isinstance(chunk, FileChunk) else None
+            if not file_symbols:
+                symbols.append([])
+                continue
+            if id(chunk.file) not in file_starts:
+                file_starts[id(chunk.file)] = [symbol.start_byte for symbol in file_symbols]
+            starts = file_starts[id(chunk.file)]
+            symbols.append(file_symbols[bisect_left(starts, chunk.start_byte): bisect_left(starts, chunk.end_byte)])
+        self.lexical_index.add(self.index_name, documents, texts, symbols)
 
-    def embed_dataset(self):
-        chunks_per_batch = 64
-        chunk_count = 0
+    def _upload_batch(self, batch: List[Chunk], stats: IngestStats,
+                      on_uploaded: Callable[[List[Chunk], Set[str]], None]):
+        start = time.perf_counter()
+        logger.info("Indexing %d chunks...", len(batch))
+        rejected = self._add_documents(batch, stats)
+        if self.lexical_index is not None:
+            self._add_lexical_documents(batch)
+        stats.add_upload(len(batch), len(rejected), time.perf_counter() - start)
+        on_uploaded(batch, set(rejected))
+
+    def embed_dataset(self, file_paths: Optional[Set[str]] = None,
+                      on_file_indexed: Optional[Callable[[str, List[str], bool], None]] = None
+                      ) -> Tuple[Dict[str, List[str]], Set[str]]:
+        """Chunks the repository and uploads the chunks to the index.
+
+        Chunking runs in the calling thread while `upload_workers` threads send batches concurrently. At most two
+        batches per upload worker are in flight; beyond that chunking waits, so memory stays bounded when the vector
+        store is slow.
+
+        Args:
+            file_paths: When set, only these files are indexed (see `RepositoryManager.walk`).
+            on_file_indexed: Called with the file path, chunk IDs and whether the index accepted all of them once all
+                chunks of a file have been uploaded, e.g. to checkpoint progress. Calls come from the upload threads,
+                but never run concurrently.
+
+        Returns:
+            The IDs of the chunks indexed for each file, including files without any chunk, and the files some chunks
+            of which the index rejected, which should be indexed again.
+        """
+        if not self.store_text:
+            self.commit = self.repo_manager.head_commit()
+        max_in_flight = 2 * self.upload_workers
+        # Chunks uploaded with their vector (see `_add_documents`) are that much larger.
+        with_vectors = self.embedding_cache is not None or not self.store_text
+        stats = IngestStats()
+        file_chunk_ids = {}
         batch = []
+        batch_bytes = batch_tokens = 0
+        in_flight = deque()
+        # Number of chunks of each file that are not uploaded yet.
+        pending_chunks = {}
+        # Files with chunks rejected by the index.
+        rejected_files = set()
+        pending_lock = threading.Lock()
+
+        def file_done(file_path: str):
+            if on_file_indexed is not None:
+                on_file_indexed(file_path, file_chunk_ids[file_path], file_path not in rejected_files)
+
+        def chunks_uploaded(uploaded: List[Chunk], rejected_ids: Set[str]):
+            with pending_lock:
+                for chunk in uploaded:
+                    if chunk.id in rejected_ids:
+                        rejected_files.add(chunk.filename)
+                    pending_chunks[chunk.filename] -= 1
+                    if pending_chunks[chunk.filename] == 0:
+                        del pending_chunks[chunk.filename]
+                        file_done(chunk.filename)
+
+        with ThreadPoolExecutor(max_workers=self.upload_workers, thread_name_prefix="upload") as executor:
+            def submit(sub_batch: List[Chunk]):
+                if len(in_flight) >= max_in_flight:
+                    start = time.perf_counter()
+                    # Also re-raises the error if the upload failed.
+                    in_flight.popleft().result()
+                    stats.backpressure_seconds += time.perf_counter() - start
+                in_flight.append(executor.submit(self._upload_batch, sub_batch, stats, chunks_uploaded))
+
+            files = self._chunk_files(file_paths)
+            while True:
+                start = time.perf_counter()
+                metadata, chunks = next(files, (None, None))
+                stats.chunk_seconds += time.perf_counter() - start
+                if metadata is None:
+                    break
+
+                file_path = metadata["file_path"]
+                file_chunk_ids[file_path] = [chunk.id for chunk in chunks]
+                with pending_lock:
+                    if chunks:
+                        # Set before any chunk is submitted, so the file can't be reported done too early.
+                        pending_chunks[file_path] = len(chunks)
+                    else:
+                        file_done(file_path)
+                stats.files += 1
+                stats.chunks += len(chunks)
+                for chunk in chunks:
+                    chunk_bytes = chunk.payload_bytes
+                    if with_vectors:
+                        dimension = self._vector_dimension or DEFAULT_VECTOR_DIMENSION
+                        chunk_bytes += VECTOR_BYTES_PER_DIMENSION * dimension
+                    if batch and (len(batch) >= self.max_batch_documents
+                                  or batch_bytes + chunk_bytes > self.max_batch_bytes
+                                  or batch_tokens + chunk.num_tokens > self.max_batch_tokens):
+                        submit(batch)
+                        batch = []
+                        batch_bytes = batch_tokens = 0
+                    batch.append(chunk)
+                    batch_bytes += chunk_bytes
+                    batch_tokens += chunk.num_tokens
+            if batch:
+                submit(batch)
+
+            while in_flight:
+                in_flight.popleft().result()
 
-        for content, metadata in self.repo_manager.walk():
-            chunks = self.chunker.chunk(content, metadata)
-            chunk_count += len(chunks)
-            batch.extend(chunks)
-            if len(batch) > chunks_per_batch:
-                for i in range(0, len(batch), chunks_per_batch):
-                    sub_batch = batch[i: i + chunks_per_batch]
-                    logger.info("Indexing %d chunks...", len(sub_batch))
-                    self.index.add_documents(
-                        documents=[chunk.metadata for chunk in sub_batch],
-                        tensor_fields=["text"],
-                    )
-
-                batch = []
-        if batch:
-            self.index.add_documents(documents=[chunk.metadata for chunk in batch], tensor_fields=["text"])
-
-        logger.info(f"Successfully embedded {chunk_count} chunks.")
+        logger.info(f"Successfully embedded {stats.chunks} chunks.")
+        stats.report()
+        if rejected_files:
+            logger.warning("%d files have chunks rejected by the index; they will be indexed again on the next run.",
+                           len(rejected_files))
+        return file_chunk_ids, rejected_files
@@ -0,0 +1,94 @@
+"""On-disk cache of chunk embeddings, so that re-indexing unchanged text doesn't recompute its vectors."""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from typing import List, Optional, Sequence
+
+from biz.util.log import logger
+
+
+class EmbeddingCache:
+    """Embeddings keyed by (model, SHA-256 of the embedded text), stored in a SQLite database.
+
+    The same text embedded by the same model always gives the same vector. The embedded text of a chunk starts with its
+    file path, which includes the repository, so in practice vectors are reused when a repository is indexed again
+    (an overwritten index, or files re-indexed after a change) for the chunks whose file path and content haven't
+    changed; other branches or forks of the repository have other paths and don't share vectors. Vectors are stored as
+    float32. When the database grows beyond `max_bytes`, the least recently used entries are evicted.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 1024 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # Shared by the upload threads; the lock serializes access to the connection.
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "key BLOB PRIMARY KEY, vector BLOB NOT NULL, size INTEGER NOT NULL, used_at REAL NOT NULL)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS embeddings_used_at ON embeddings (used_at)")
+            self._size = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM embeddings").fetchone()[0]
+
+    @staticmethod
+    def _key(model: str, text: str) -> bytes:
+        return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).digest()
+
+    def get_many(self, model: str, texts: Sequence[str]) -> List[Optional[List[float]]]:
+        """The cached vector of each text, or None where it isn't cached."""
+        keys = [self._key(model, text) for text in texts]
+        with self._lock, self._connection:
+            found = {}
+            # Stay well below SQLite's limit on the number of query parameters.
+            for i in range(0, len(keys), 500):
+                sub_keys = keys[i: i + 500]
+                placeholders = ",".join("?" * len(sub_keys))
+                found.update(self._connection.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", sub_keys).fetchall())
+            if found:
+                now = time.time()
+                self._connection.executemany("UPDATE embeddings SET used_at = ? WHERE key = ?",
+                                             [(now, key) for key in found])
+        return [array("f", found[key]).tolist() if key in found else None for key in keys]
+
+    def put_many(self, model: str, texts: Sequence[str], vectors: Sequence[Sequence[float]]):
+        """Stores the vectors of the given texts, then evicts the least recently used entries if the cache is full."""
+        now = time.time()
+        rows = []
+        for text, vector in zip(texts, vectors):
+            blob = array("f", vector).tobytes()
+            # The key and the row overhead count towards the size too.
+            rows.append((self._key(model, text), blob, len(blob) + 64, now))
+        with self._lock, self._connection:
+            for key, blob, size, used_at in rows:
+                previous = self._connection.execute("SELECT size FROM embeddings WHERE key = ?", (key,)).fetchone()
+                self._connection.execute("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)",
+                                         (key, blob, size, used_at))
+                self._size += size - (previous[0] if previous else 0)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """Evicts the least recently used entries until the cache is at 90% of its maximum size."""
+        target = int(self.max_bytes * 0.9)
+        evicted = 0
+        cursor = self._connection.execute("SELECT key, size FROM embeddings ORDER BY used_at")
+        keys = []
+        for key, size in cursor:
+            if self._size <= target:
+                break
+            keys.append((key,))
+            self._size -= size
+            evicted += 1
+        self._connection.executemany("DELETE FROM embeddings WHERE key = ?", keys)
+        logger.info("Evicted %d embeddings from the cache %s.", evicted, self.path)
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,108 @@
+"""Keeps the conversation history sent to the chat model within a token budget, summarizing older turns."""
+
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from biz.chunker import tokenizer
+from biz.util.log import logger
+
+
+class HistoryManager:
+    """Splits a conversation into recent turns, sent verbatim, and older turns, sent as a rolling summary.
+
+    The most recent turns (a user message and the answers to it) are kept as long as they fit in `max_tokens`; the
+    current question is always kept. The start of the window is rounded to `summary_step` turns, so the summary, and
+    with it the prompt prefix, only changes once every few turns. Summaries are cached by a hash of the turns they
+    cover, and a summary of more turns is made from the cached summary of fewer turns plus the turns since.
+    """
+
+    def __init__(self, summarize: Callable[[Optional[str], List[Dict[str, str]]], Awaitable[str]],
+                 max_tokens: int = 4000, summary_step: int = 4, footer: Optional[str] = None, encoding=None,
+                 max_summaries: int = 256):
+        """
+        :param summarize: Coroutine function making a summary from the previous summary, if any, and the messages that
+            follow it.
+        :param footer: Text appended to answers that isn't sent back to the model: answers are cut where it starts.
+        :param max_summaries: Summaries kept in the cache, shared by all conversations.
+        """
+        self.summarize = summarize
+        self.max_tokens = max_tokens
+        self.summary_step = max(summary_step, 1)
+        self.footer = footer
+        self.encoding = encoding or tokenizer
+        self.max_summaries = max_summaries
+        self._summaries: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _clean(self, messages: List[Dict]) -> List[Dict[str, str]]:
+        """The user and assistant messages, with only their role and content, and footers removed."""
+        cleaned = []
+        for message in messages:
+            content = message.get("content")
+            if message["role"] == "system" or not content:
+                continue
+            if self.footer and message["role"] == "assistant" and self.footer in content:
+                content = content[:content.index(self.footer)]
+            cleaned.append({"role": message["role"], "content": content})
+        return cleaned
+
+    @staticmethod
+    def _turns(messages: List[Dict[str, str]]) -> List[List[Dict[str, str]]]:
+        turns = []
+        for message in messages:
+            if message["role"] == "user" or not turns:
+                turns.append([])
+            turns[-1].append(message)
+        return turns
+
+    def _tokens(self, turn: List[Dict[str, str]]) -> int:
+        return sum(len(self.encoding.encode(message["content"], disallowed_special=())) for message in turn)
+
+    async def prepare(self, messages: List[Dict]) -> Tuple[Optional[str], List[Dict[str, str]]]:
+        """The summary of the older turns, if any, and the messages of the recent turns."""
+        turns = self._turns(self._clean(messages))
+        kept = 0
+        used_tokens = 0
+        for turn in reversed(turns):
+            tokens = self._tokens(turn)
+            if kept and used_tokens + tokens > self.max_tokens:
+                break
+            kept += 1
+            used_tokens += tokens
+        start = len(turns) - kept
+        if start == 0:
+            return None, [message for turn in turns for message in turn]
+        start = min(-(-start // self.summary_step) * self.summary_step, len(turns) - 1)
+        return await self._summary(turns[:start]), [message for turn in turns[start:] for message in turn]
+
+    async def _summary(self, turns: List[List[Dict[str, str]]]) -> Optional[str]:
+        # The key of the summary of each prefix of the turns.
+        keys = []
+        digest = hashlib.sha256()
+        for turn in turns:
+            digest.update(json.dumps(turn, ensure_ascii=False).encode("utf-8"))
+            keys.append(digest.hexdigest())
+
+        with self._lock:
+            # The longest prefix already summarized.
+            covered = next((i + 1 for i in range(len(keys) - 1, -1, -1) if keys[i] in self._summaries), 0)
+            previous = self._summaries[keys[covered - 1]] if covered else None
+            if covered:
+                self._summaries.move_to_end(keys[covered - 1])
+        if covered == len(turns):
+            return previous
+
+        try:
+            summary = await self.summarize(previous, [message for turn in turns[covered:] for message in turn])
+        except Exception as e:
+            # Without a new summary, the turns since the previous one are left out of the prompt.
+            logger.warning(f"Failed to summarize the conversation history: {e}")
+            return previous
+        with self._lock:
+            self._summaries[keys[-1]] = summary
+            while len(self._summaries) > self.max_summaries:
+                self._summaries.popitem(last=False)
+        return summary
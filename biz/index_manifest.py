@@ -0,0 +1,143 @@
+"""Records which version of each file is in an index, so that later runs only re-index what changed."""
+
+import json
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from biz.util.log import logger
+
+
+class IndexManifest:
+    """The indexed commit, plus the git blob SHA and chunk IDs of every indexed file.
+
+    Stored as JSON:
+        {"commit": "<sha>", "status": "done", "files": {"<file_path>": {"blob": "<sha>", "chunk_ids": ["<id>", ...]}},
+         "stale_chunk_ids": ["<id>", ...]}
+    where file paths are in the `RepositoryManager.walk` format (e.g. "org/repo/your/file/path.py").
+
+    While a build is running, the status is "in_progress" and the commit is still the previously completed one; the
+    files already uploaded are recorded as they complete (see `IndexCheckpoint`). The chunk IDs they replace are kept
+    in `stale_chunk_ids` until they are deleted from the index, so that an interrupted build doesn't lose track of them.
+    """
+
+    def __init__(self, path: str, commit: Optional[str] = None, files: Optional[Dict[str, Dict]] = None,
+                 status: str = "done", stale_chunk_ids: Optional[List[str]] = None):
+        self.path = path
+        self.commit = commit
+        self.files = files or {}
+        self.status = status
+        self.stale_chunk_ids = stale_chunk_ids or []
+
+    @classmethod
+    def load(cls, path: str) -> Optional["IndexManifest"]:
+        """Loads the manifest at `path`. Returns None if it doesn't exist or can't be read."""
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            return cls(path, commit=data["commit"], files=data["files"], status=data.get("status", "done"),
+                       stale_chunk_ids=data.get("stale_chunk_ids"))
+        except (json.JSONDecodeError, KeyError) as e:
+            logger.error(f"读取索引清单 {path} 失败: {e}")
+            return None
+
+    def save(self):
+        """Writes the manifest atomically, so that an interrupted run never leaves a truncated file behind."""
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"commit": self.commit, "status": self.status, "files": self.files,
+                       "stale_chunk_ids": self.stale_chunk_ids}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def diff(self, blobs: Dict[str, str]) -> Tuple[Set[str], Set[str]]:
+        """Compares the manifest with the blob SHAs of the files at the new commit.
+
+        Returns the files that were added or modified, and the files that were deleted.
+        """
+        changed = {path for path, blob in blobs.items()
+                   if path not in self.files or self.files[path]["blob"] != blob}
+        deleted = {path for path in self.files if path not in blobs}
+        return changed, deleted
+
+    def set_file(self, path: str, blob: Optional[str], chunk_ids: List[str]):
+        """Records the chunks of a re-indexed file, and marks the chunks it replaces as stale."""
+        self._mark_stale(path)
+        self.files[path] = {"blob": blob, "chunk_ids": chunk_ids}
+
+    def update(self, commit: str, blobs: Dict[str, str], file_chunk_ids: Dict[str, List[str]], changed: Set[str],
+               deleted: Set[str] = frozenset(), incomplete: Set[str] = frozenset()):
+        """Records the new commit, the re-indexed files and forgets deleted ones.
+
+        Changed files without chunks (e.g. ignored or empty files) are recorded too, so they don't show up as changed
+        again on the next run. Incomplete files (some chunks of which the index rejected) are recorded without a blob,
+        so they do: their chunks are tracked, but the next run indexes them again.
+        """
+        self.commit = commit
+        self.status = "done"
+        for path in deleted:
+            self._mark_stale(path)
+            self.files.pop(path, None)
+        for path in changed:
+            self.set_file(path, None if path in incomplete else blobs[path], file_chunk_ids.get(path, []))
+
+    def stale_ids(self) -> List[str]:
+        """Stale chunk IDs that are safe to delete from the index.
+
+        A re-indexed file may produce chunks with the same IDs as its old ones (they have been overwritten), so IDs still
+        referenced by an indexed file are left out.
+        """
+        live = {chunk_id for entry in self.files.values() for chunk_id in entry["chunk_ids"]}
+        return [chunk_id for chunk_id in dict.fromkeys(self.stale_chunk_ids) if chunk_id not in live]
+
+    def _mark_stale(self, path: str):
+        entry = self.files.get(path)
+        if entry:
+            self.stale_chunk_ids.extend(entry["chunk_ids"])
+
+
+class IndexCheckpoint:
+    """Records files in the manifest as soon as they are fully uploaded, and saves it periodically, so that an
+    interrupted build can be resumed without re-indexing them. Files with chunks rejected by the index are recorded
+    without a blob, so that resuming indexes them again.
+
+    Meant to be passed as `on_file_indexed` to `Embedder.embed_dataset`.
+    """
+
+    def __init__(self, manifest: IndexManifest, blobs: Dict[str, str], total_files: int,
+                 interval_seconds: float = 10.0, on_save: Optional[Callable[[int, int], None]] = None):
+        """
+        Args:
+            total_files: Number of files to index in this build, for progress reporting.
+            interval_seconds: Minimum time between two saves of the manifest.
+            on_save: Called with (indexed_files, total_files) after each save.
+        """
+        self.manifest = manifest
+        self.blobs = blobs
+        self.total_files = total_files
+        self.indexed_files = 0
+        self.interval_seconds = interval_seconds
+        self.on_save = on_save
+        self._last_save = time.monotonic()
+        self._lock = threading.Lock()
+        self.manifest.status = "in_progress"
+
+    def __call__(self, file_path: str, chunk_ids: List[str], complete: bool = True):
+        with self._lock:
+            self.manifest.set_file(file_path, self.blobs.get(file_path) if complete else None, chunk_ids)
+            self.indexed_files += 1
+            if time.monotonic() - self._last_save >= self.interval_seconds:
+                self._save()
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        self.manifest.save()
+        self._last_save = time.monotonic()
+        if self.on_save is not None:
+            self.on_save(self.indexed_files, self.total_files)
@@ -0,0 +1,196 @@
+"""Keyword (BM25) index of chunks, to find the exact identifiers, error messages and config keys embeddings miss."""
+
+import json
+import os
+import re
+import sqlite3
+import threading
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from biz.util.log import logger
+
+# Words made of letters, digits and underscores; other characters (including CJK text) are left to vector search.
+_WORD_RE = re.compile(r"[A-Za-z0-9_]+")
+# The parts of a camelCase or PascalCase word: "HTTPServerError2" -> "HTTP", "Server", "Error", "2".
+_CAMEL_PART_RE = re.compile(r"[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|[0-9]+")
+# A possibly dotted name, optionally called: "biz.vector_store.VectorStore", "search()".
+_CODE_WORD_RE = re.compile(r"([A-Za-z_$][\w$]*(?:\.[A-Za-z_$][\w$]*)*)(\(\))?")
+# Names that don't read as prose: an inner underscore, a lowercase letter followed by an uppercase one, or an
+# acronym followed by a word ("JSONDecoder", "HTTPServer").
+_IDENTIFIER_SHAPE_RE = re.compile(r"[A-Za-z0-9]_[A-Za-z0-9]|[a-z][A-Z]|[A-Z]{2,}[a-z]")
+# A capitalized word, which may be a class name ("Embedder") as well as prose ("How", "Docker").
+_CAPITALIZED_RE = re.compile(r"[A-Z][a-z0-9]+")
+
+# Terms of a query beyond this many are ignored, which bounds the cost of long chat histories.
+MAX_QUERY_TERMS = 64
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase terms of a text, code-aware: each identifier is kept whole and also split into its snake_case and
+    camelCase parts, so that "getUserName" matches both "getusername" and "user name"."""
+    terms = []
+    for word in _WORD_RE.findall(text):
+        parts = [part for snake_part in word.split("_") for part in _CAMEL_PART_RE.findall(snake_part)]
+        if len(word) > 1:
+            terms.append(word.lower())
+        if len(parts) > 1:
+            terms.extend(part.lower() for part in parts if len(part) > 1)
+    return terms
+
+
+def identifiers(text: str) -> List[str]:
+    """The words of a text that look like code identifiers rather than prose: snake_case, camelCase or PascalCase
+    words, and the parts of dotted names and calls ("VectorStore.search", "main()")."""
+    names = []
+    for match in _CODE_WORD_RE.finditer(text):
+        parts = match.group(1).split(".")
+        if len(parts) > 1 or match.group(2):
+            names.extend(parts)
+        elif _IDENTIFIER_SHAPE_RE.search(match.group(1)):
+            names.append(match.group(1))
+    return list(dict.fromkeys(names))
+
+
+def capitalized_words(text: str) -> List[str]:
+    """The capitalized words of a text that `identifiers` leaves out. They are only names if the symbol table has a
+    definition of them, so they are looked up (see `LexicalIndex.find_symbols`) but never searched as identifiers."""
+    names = set(identifiers(text))
+    words = [match.group(1) for match in _CODE_WORD_RE.finditer(text)
+             if not match.group(2) and _CAPITALIZED_RE.fullmatch(match.group(1))]
+    return [word for word in dict.fromkeys(words) if word not in names]
+
+
+class LexicalIndex:
+    """BM25 indexes of chunks, one SQLite database per index under `data_dir`, using SQLite's FTS5 full-text search.
+
+    Chunks are tokenized by `tokenize` before they are stored, so FTS5 only splits the resulting terms on spaces. Each
+    chunk is stored with the same metadata as in the vector store, so lexical hits can be returned like vector hits.
+
+    The database also holds the symbol table of the index: the name, kind and byte range of each definition in the
+    code files, with the chunk it starts in, so that a definition is found by an indexed lookup of its exact name.
+    """
+
+    def __init__(self, data_dir: str):
+        self.data_dir = data_dir
+        self._connections = {}
+        self._lock = threading.Lock()
+
+    def _path(self, index_name: str) -> str:
+        return os.path.join(self.data_dir, f"{index_name}.sqlite")
+
+    def exists(self, index_name: str) -> bool:
+        return os.path.exists(self._path(index_name))
+
+    def _connection(self, index_name: str) -> sqlite3.Connection:
+        """The connection to the index's database, created if needed. Callers hold the lock."""
+        if index_name not in self._connections:
+            os.makedirs(self.data_dir, exist_ok=True)
+            connection = sqlite3.connect(self._path(index_name), check_same_thread=False)
+            with connection:
+                connection.execute("PRAGMA journal_mode=WAL")
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS documents (row INTEGER PRIMARY KEY, id TEXT UNIQUE NOT NULL, "
+                    "metadata TEXT NOT NULL)")
+                connection.execute("CREATE VIRTUAL TABLE IF NOT EXISTS chunk_terms "
+                                   "USING fts5(terms, tokenize=\"unicode61 tokenchars '_'\")")
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS symbols (name TEXT NOT NULL, kind TEXT NOT NULL, "
+                    "start_byte INTEGER NOT NULL, end_byte INTEGER NOT NULL, document INTEGER NOT NULL)")
+                connection.execute("CREATE INDEX IF NOT EXISTS symbols_name ON symbols (name)")
+                connection.execute("CREATE INDEX IF NOT EXISTS symbols_document ON symbols (document)")
+            self._connections[index_name] = connection
+        return self._connections[index_name]
+
+    def add(self, index_name: str, documents: List[Dict[str, Any]], texts: List[str],
+            symbols: Optional[List[Sequence[Tuple[str, str, int, int]]]] = None):
+        """Adds or replaces documents by "_id", indexing the terms of the corresponding texts and the symbols defined
+        in each document, if any, as (name, kind, start_byte, end_byte) tuples (see `biz.chunker.Symbol`)."""
+        with self._lock:
+            connection = self._connection(index_name)
+            with connection:
+                self._delete(connection, [document["_id"] for document in documents])
+                for i, (document, text) in enumerate(zip(documents, texts)):
+                    row = connection.execute("INSERT INTO documents (id, metadata) VALUES (?, ?)",
+                                             (document["_id"], json.dumps(document, ensure_ascii=False))).lastrowid
+                    connection.execute("INSERT INTO chunk_terms (rowid, terms) VALUES (?, ?)",
+                                       (row, " ".join(tokenize(text))))
+                    if symbols:
+                        connection.executemany("INSERT INTO symbols VALUES (?, ?, ?, ?, ?)",
+                                               [(*symbol, row) for symbol in symbols[i]])
+
+    @staticmethod
+    def _delete(connection: sqlite3.Connection, ids: List[str]):
+        for i in range(0, len(ids), 500):
+            sub_ids = ids[i: i + 500]
+            placeholders = ",".join("?" * len(sub_ids))
+            rows = [(row,) for row, in connection.execute(
+                f"SELECT row FROM documents WHERE id IN ({placeholders})", sub_ids)]
+            connection.executemany("DELETE FROM chunk_terms WHERE rowid = ?", rows)
+            connection.executemany("DELETE FROM symbols WHERE document = ?", rows)
+            connection.executemany("DELETE FROM documents WHERE row = ?", rows)
+
+    def delete(self, index_name: str, ids: List[str]):
+        """Deletes documents by "_id". Unknown IDs are ignored."""
+        if not self.exists(index_name):
+            return
+        with self._lock:
+            connection = self._connection(index_name)
+            with connection:
+                self._delete(connection, ids)
+
+    def delete_index(self, index_name: str):
+        with self._lock:
+            connection = self._connections.pop(index_name, None)
+            if connection is not None:
+                connection.close()
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(self._path(index_name) + suffix):
+                    os.remove(self._path(index_name) + suffix)
+
+    def search(self, index_name: str, query: str, limit: int) -> List[Dict[str, Any]]:
+        """The metadata of the documents matching the most query terms, best BM25 score first, with their "_bm25_score".
+
+        Returns nothing for indexes built without a lexical index and queries without any term.
+        """
+        terms = list(dict.fromkeys(tokenize(query)))[:MAX_QUERY_TERMS]
+        if not terms or not self.exists(index_name):
+            return []
+        # Any of the terms; quoted, so that FTS5 doesn't read them as operators.
+        match = " OR ".join(f'"{term}"' for term in terms)
+        with self._lock:
+            try:
+                rows = self._connection(index_name).execute(
+                    "SELECT documents.metadata, chunk_terms.rank FROM chunk_terms "
+                    "JOIN documents ON documents.row = chunk_terms.rowid "
+                    "WHERE chunk_terms MATCH ? ORDER BY chunk_terms.rank LIMIT ?", (match, limit)).fetchall()
+            except sqlite3.Error as e:
+                logger.error(f"Lexical search of index {index_name} failed: {e}")
+                return []
+        hits = []
+        for metadata, rank in rows:
+            hit = json.loads(metadata)
+            # FTS5 ranks better matches lower.
+            hit["_bm25_score"] = -rank
+            hits.append(hit)
+        return hits
+
+    def find_symbols(self, index_name: str, names: Sequence[str], limit: int) -> List[Dict[str, Any]]:
+        """The metadata of the documents in which the named symbols are defined, in the order of `names`, each with the
+        "_symbol" found in it ({"name", "kind", "start_byte", "end_byte"}). Names are matched exactly.
+        """
+        names = list(dict.fromkeys(names))
+        if not names or not self.exists(index_name):
+            return []
+        placeholders = ",".join("?" * len(names))
+        with self._lock:
+            rows = self._connection(index_name).execute(
+                "SELECT symbols.name, symbols.kind, symbols.start_byte, symbols.end_byte, documents.metadata "
+                "FROM symbols JOIN documents ON documents.row = symbols.document "
+                f"WHERE symbols.name IN ({placeholders})", names).fetchall()
+        order = {name: i for i, name in enumerate(names)}
+        hits = []
+        for name, kind, start_byte, end_byte, metadata in sorted(rows, key=lambda row: order[row[0]])[:limit]:
+            hit = json.loads(metadata)
+            hit["_symbol"] = {"name": name, "kind": kind, "start_byte": start_byte, "end_byte": end_byte}
+            hits.append(hit)
+        return hits
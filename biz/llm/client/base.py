@@ -1,5 +1,5 @@
 from abc import abstractmethod
-from typing import List, Dict, Literal, Any
+from typing import List, Dict, Literal, Any, AsyncIterator
 
 from biz.llm.types import ChatChunk
 
@@ -15,6 +15,15 @@ class BaseClient:
     def chat_stream(self, messages: List[Dict[str, str]], model: str, temperature: float = 0.7) -> Any:
         """Chat with the model, streaming the results."""
 
+    @abstractmethod
+    async def achat(self, messages: List[Dict[str, str]], model: str, temperature: float = 0.7) -> str:
+        """Chat with the model, without blocking the event loop."""
+
+    @abstractmethod
+    def achat_stream(self, messages: List[Dict[str, str]], model: str,
+                     temperature: float = 0.7) -> AsyncIterator[Any]:
+        """Chat with the model, streaming the results as an async iterator of chunks (see `convert_to_chunk`)."""
+
     @abstractmethod
     def convert_to_chunk(self, chunk) -> ChatChunk:
         """Convert a chunk to a Chunk object."""
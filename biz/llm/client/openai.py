@@ -1,10 +1,11 @@
 import os
-from typing import Dict, List, Any
+from typing import Dict, List, Any, AsyncIterator
 
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
 
 from biz.llm.client.base import BaseClient
 from biz.llm.types import ChatChunk
+from biz.util.concurrency import ConcurrencyLimiter
 
 
 class OpenAIClient(BaseClient):
@@ -14,7 +15,10 @@ class OpenAIClient(BaseClient):
             raise ValueError("API key is required. Please provide it or set it in the environment variables.")
 
         self.client = OpenAI(api_key=self.api_key)
+        self.async_client = AsyncOpenAI(api_key=self.api_key)
         self.default_model = os.getenv("OPENAI_API_MODEL", "gpt-4o-mini")
+        # 同时向 openai 发送的异步请求数上限，超出的请求排队等待
+        self.limiter = ConcurrencyLimiter("openai", int(os.getenv("OPENAI_MAX_CONCURRENCY", 16)))
 
     def chat(self, messages: List[Dict[str, str]], model: str = "gpt-4o-mini") -> str:
 
@@ -30,11 +34,45 @@ class OpenAIClient(BaseClient):
             messages=messages,
             model=model,
             stream=True,
+            # 最后一个 chunk 返回本次请求的 token 用量，包括命中提示词缓存的 token 数
+            stream_options={"include_usage": True},
             timeout=10  # 10秒钟未响应，则超时
         )
         return completions
 
+    async def achat(self, messages: List[Dict[str, str]], model: str = "gpt-4o-mini") -> str:
+        async with self.limiter.acquire():
+            completions = await self.async_client.chat.completions.create(
+                messages=messages,
+                model=model,
+            )
+        return completions.choices[0].message.content
+
+    async def achat_stream(self, messages: List[Dict[str, str]], model: str = "gpt-4o-mini") -> AsyncIterator[Any]:
+        """Chat with the model, streaming the results without blocking the event loop."""
+        async with self.limiter.acquire():
+            completions = await self.async_client.chat.completions.create(
+                messages=messages,
+                model=model,
+                stream=True,
+                stream_options={"include_usage": True},
+                timeout=10  # 10秒钟未响应，则超时
+            )
+            # 提前结束迭代（例如用户断开连接）时关闭连接
+            async with completions:
+                async for chunk in completions:
+                    yield chunk
+
     def convert_to_chunk(self, chunk) -> ChatChunk:
+        if not chunk.choices:
+            usage = chunk.usage
+            if usage is None:
+                return ChatChunk(type="chunk")
+            return ChatChunk(type="usage", usage={
+                "prompt_tokens": usage.prompt_tokens,
+                "cached_tokens": getattr(usage.prompt_tokens_details, "cached_tokens", None) or 0,
+                "completion_tokens": usage.completion_tokens,
+            })
         if chunk.choices[0].delta.content is not None:
             content = chunk.choices[0].delta.content
             return ChatChunk(type="chunk", content=content)
@@ -1,16 +1,21 @@
-from typing import Literal
+from typing import Dict, Literal
 
 
 class ChatChunk:
-    """ A chunk of text. """
-    type = Literal["chunk", "stop"]
+    """ A chunk of text, or the token usage of the response. """
+    type = Literal["chunk", "stop", "usage"]
 
-    def __init__(self, type: Literal["chunk", "stop"], content: str = None):
+    def __init__(self, type: Literal["chunk", "stop", "usage"], content: str = None, usage: Dict[str, int] = None):
         self.type = type
         self.content = content
+        # prompt_tokens, cached_tokens (the part of the prompt served from the provider's prompt cache), completion_tokens
+        self.usage = usage
 
     def is_chunk(self):
         return self.type == "chunk"
 
     def is_stop(self):
-        return self.type == "stop"
\ No newline at end of file
+        return self.type == "stop"
+
+    def is_usage(self):
+        return self.type == "usage"
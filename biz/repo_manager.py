@@ -3,7 +3,7 @@
 import logging
 import os
 from functools import cached_property
-from typing import Any, Dict, Generator, Tuple
+from typing import Any, Dict, Generator, Optional, Set, Tuple
 
 import requests
 from git import GitCommandError, Repo
@@ -123,6 +123,26 @@ class RepositoryManager():
 
         return True
 
+    def head_commit(self) -> str:
+        """Returns the SHA of the commit checked out in the local clone."""
+        return Repo(self.local_path).head.commit.hexsha
+
+    def file_blobs(self) -> Dict[str, str]:
+        """Maps every file at the checked-out commit to its git blob SHA.
+        File paths are in the same format as in `walk` (e.g. "org/repo/your/file/path.py").
+        """
+        repo = Repo(self.local_path)
+        blobs = {}
+        # -z keeps paths with special characters unquoted.
+        for entry in repo.git.ls_tree("-r", "-z", "HEAD").split("\0"):
+            if not entry:
+                continue
+            info, path = entry.split("\t", 1)
+            _, object_type, sha = info.split()
+            if object_type == "blob":
+                blobs[os.path.join(self.repo_id, path)] = sha
+        return blobs
+
     def _parse_filter_file(self, file_path: str) -> bool:
         """Parses a file with files/directories/extensions to include/exclude.
 
@@ -204,12 +224,14 @@ class RepositoryManager():
         spec = self._load_ignore_spec()  # 获取缓存的 PathSpec 对象
         return not spec.match_file(repo_file_path)
 
-    def walk(self, get_content: bool = True) -> Generator[Tuple[Any, Dict], None, None]:
+    def walk(self, get_content: bool = True,
+             only_paths: Optional[Set[str]] = None) -> Generator[Tuple[Any, Dict], None, None]:
         """Walks the local repository path and yields a tuple of (content, metadata) for each file.
         The filepath is relative to the root of the repository (e.g. "org/repo/your/file/path.py").
 
         Args:
             get_content: When set to True, yields (content, metadata) tuples. When set to False, yields metadata only.
+            only_paths: When set, only these files are yielded (if they are not ignored).
         """
         # We will keep appending to these files during the iteration, so we need to clear them first.
         repo_name = self.repo_id.replace("/", "_")
@@ -237,6 +259,8 @@ class RepositoryManager():
 
             for file_path in included_file_paths:
                 relative_file_path = file_path[len(self.local_dir) + 1:]
+                if only_paths is not None and relative_file_path not in only_paths:
+                    continue
                 metadata = {
                     "file_path": relative_file_path,
                     "url": self.url_for_file(relative_file_path),
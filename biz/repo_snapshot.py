@@ -0,0 +1,89 @@
+"""Reads chunk text back from the local clones of the indexed repositories."""
+
+import mmap
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from git import BadName, InvalidGitRepositoryError, NoSuchPathError, Repo
+
+from biz.util.log import logger
+
+
+class RepoSnapshot:
+    """Hydrates chunks stored by position only (file path, byte range and commit) with their text.
+
+    Files are read from the working tree of the local clone through memory maps, so a chunk only costs the pages it
+    spans. A chunk indexed at an older commit is read from the working tree too when its file hasn't changed since;
+    otherwise its content at that commit is read from the git object store.
+    """
+
+    def __init__(self, local_dir: str, max_open_files: int = 128):
+        """
+        Args:
+            local_dir: The directory the repositories were cloned into (`RepositoryManager.local_dir`). Chunk file paths
+                are relative to it.
+            max_open_files: How many files are kept memory mapped at the same time.
+        """
+        self.local_dir = local_dir
+        self.max_open_files = max_open_files
+        self._repos = {}
+        self._maps = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _repo(self, file_path: str) -> Optional[Repo]:
+        """The clone containing a file. File paths start with the repository ID, which may contain several slashes."""
+        directory = os.path.dirname(os.path.join(self.local_dir, file_path))
+        if directory not in self._repos:
+            try:
+                self._repos[directory] = Repo(directory, search_parent_directories=True)
+            except (InvalidGitRepositoryError, NoSuchPathError) as e:
+                logger.warning(f"找不到文件 {file_path} 所在的代码仓库: {e}")
+                self._repos[directory] = None
+        return self._repos[directory]
+
+    def _mapped(self, absolute_path: str) -> mmap.mmap:
+        stat = os.stat(absolute_path)
+        # A file rewritten by a pull gets a new mapping.
+        key = (absolute_path, stat.st_mtime_ns, stat.st_size)
+        if key in self._maps:
+            self._maps.move_to_end(key)
+            return self._maps[key]
+        with open(absolute_path, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps[key] = mapped
+        if len(self._maps) > self.max_open_files:
+            _, evicted = self._maps.popitem(last=False)
+            evicted.close()
+        return mapped
+
+    def read(self, file_path: str, commit: str, start_byte: int, end_byte: int) -> Optional[bytes]:
+        """The bytes of a file at a commit, or None if the file or commit can't be found."""
+        with self._lock:
+            repo = self._repo(file_path)
+            if repo is None:
+                return None
+            absolute_path = os.path.join(self.local_dir, file_path)
+            relative_path = os.path.relpath(absolute_path, repo.working_tree_dir).replace(os.sep, "/")
+            try:
+                head = repo.head.commit
+                if head.hexsha != commit:
+                    blob = repo.commit(commit).tree / relative_path
+                    try:
+                        unchanged = (head.tree / relative_path).hexsha == blob.hexsha
+                    except KeyError:
+                        unchanged = False
+                    if not unchanged:
+                        return blob.data_stream.read()[start_byte:end_byte]
+                return self._mapped(absolute_path)[start_byte:end_byte]
+            except (BadName, KeyError, ValueError, OSError) as e:
+                logger.warning(f"无法读取 {file_path}@{commit}: {e}")
+                return None
+
+    def chunk_content(self, file_path: str, commit: str, start_byte: int, end_byte: int) -> Optional[str]:
+        """The content of a chunk, in the same format as `FileChunk.content`."""
+        data = self.read(file_path, commit, start_byte, end_byte)
+        if data is None:
+            return None
+        return file_path + "\n\n" + data.decode("utf-8", "ignore")
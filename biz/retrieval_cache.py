@@ -0,0 +1,110 @@
+"""In-memory cache of search results, so that questions asked again against an unchanged index skip the vector store."""
+
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+
+from biz.util.log import logger
+
+
+class IndexGenerations:
+    """The generation of each index, as recorded in repos.json by the indexer.
+
+    The indexer bumps the generation of an index whenever it changes it (see `add_repo_to_file` in index.py), so
+    results cached under an older generation are never served again. The file is only re-read when it was modified.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._mtime = None
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def get(self, index_name: str) -> int:
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return 0
+        with self._lock:
+            if mtime != self._mtime:
+                try:
+                    with open(self.path, "r", encoding="utf-8") as f:
+                        repos = json.load(f)
+                    self._generations = {repo["index_name"]: repo.get("generation", 0) for repo in repos}
+                    self._mtime = mtime
+                except (OSError, ValueError, KeyError, TypeError) as e:
+                    # The indexer may be rewriting the file; keep the previous generations until the next read.
+                    logger.warning(f"Failed to read index generations from {self.path}: {e}")
+            return self._generations.get(index_name, 0)
+
+
+class RetrievalCache:
+    """LRU cache of search results, bounded by an estimate of their size in bytes and by their age.
+
+    Keys must include everything the results depend on, including the generation of the index (see
+    `IndexGenerations`); entries of older generations are simply never hit again and age out.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, ttl_seconds: float = 600, report_every: int = 100):
+        """
+        :param report_every: Log the hit rate every this many lookups.
+        """
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.report_every = report_every
+        # key -> (expiry time, size, value), least recently used first.
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """The cached value, or None if it isn't cached or has expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+            lookups = self.hits + self.misses
+        if self.report_every and lookups % self.report_every == 0:
+            stats = self.stats()
+            logger.info(f"Retrieval cache: {stats['hits']} hits, {stats['misses']} misses "
+                        f"({stats['hit_rate']:.1%} hit rate), {stats['entries']} entries, {stats['bytes']} bytes.")
+        return entry[2] if entry is not None else None
+
+    def put(self, key: Hashable, value: Any, size: int):
+        """Caches a value of about `size` bytes, evicting the least recently used entries to make room."""
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, size, value)
+            self._size += size
+            while self._size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key: Hashable):
+        self._size -= self._entries.pop(key)[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0,
+                    "evictions": self.evictions, "entries": len(self._entries), "bytes": self._size}
@@ -0,0 +1,69 @@
+"""Batches the text deltas streamed by a chat model into fewer, larger UI updates."""
+
+import asyncio
+import time
+from typing import AsyncIterator
+
+from biz.util.log import logger
+
+
+class StreamCoalescer:
+    """Accumulates streamed deltas and flushes them once `interval_seconds` have passed since the last flush or
+    `max_chars` characters are pending, whichever comes first. A pending batch is also flushed when the interval
+    elapses while the model is silent, and whatever is left when the stream ends, so the concatenated batches are
+    exactly the streamed text.
+
+    Each UI update re-sends the answer so far, so after each stream the number of updates, updates per second and
+    bytes pushed (the size of the answer at each update, summed) are logged, to tune the window.
+    """
+
+    def __init__(self, interval_seconds: float = 0.05, max_chars: int = 64):
+        self.interval_seconds = interval_seconds
+        self.max_chars = max_chars
+
+    async def coalesce(self, deltas: AsyncIterator[str]) -> AsyncIterator[str]:
+        start = last_flush = time.perf_counter()
+        pending = []
+        pending_chars = 0
+        updates = 0
+        answer_bytes = 0
+        pushed_bytes = 0
+        iterator = deltas.__aiter__()
+        next_delta = None
+        try:
+            while True:
+                if next_delta is None:
+                    next_delta = asyncio.ensure_future(iterator.__anext__())
+                timeout = None
+                if pending:
+                    timeout = max(self.interval_seconds - (time.perf_counter() - last_flush), 0)
+                # Not asyncio.wait_for, which would cancel the pending read of the stream on timeout.
+                done, _ = await asyncio.wait({next_delta}, timeout=timeout)
+                finished = False
+                if done:
+                    try:
+                        delta = next_delta.result()
+                    except StopAsyncIteration:
+                        finished = True
+                    else:
+                        pending.append(delta)
+                        pending_chars += len(delta)
+                    next_delta = None
+                due = time.perf_counter() - last_flush >= self.interval_seconds or pending_chars >= self.max_chars
+                if pending and (finished or due):
+                    batch = "".join(pending)
+                    pending.clear()
+                    pending_chars = 0
+                    last_flush = time.perf_counter()
+                    updates += 1
+                    answer_bytes += len(batch.encode("utf-8"))
+                    pushed_bytes += answer_bytes
+                    yield batch
+                if finished:
+                    break
+        finally:
+            if next_delta is not None:
+                next_delta.cancel()
+            seconds = time.perf_counter() - start
+            logger.info(f"Streamed {answer_bytes} bytes in {updates} updates over {seconds:.2f}s "
+                        f"({updates / seconds if seconds else 0.0:.1f} updates/s), {pushed_bytes} bytes pushed.")
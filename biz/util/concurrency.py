@@ -0,0 +1,48 @@
+"""Concurrency limits for asyncio code, with metrics of how many callers are running and queued."""
+
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Dict
+
+
+class ConcurrencyLimiter:
+    """A semaphore that also counts the coroutines holding it and the coroutines queued for it.
+
+    A limit of 0 or less doesn't limit anything, but still counts.
+    """
+
+    def __init__(self, name: str, limit: int):
+        self.name = name
+        self.limit = limit
+        self._semaphore = asyncio.Semaphore(limit) if limit > 0 else None
+        self.active = 0
+        self.waiting = 0
+        self.max_waiting = 0
+        self.completed = 0
+        self.wait_seconds = 0.0
+
+    @asynccontextmanager
+    async def acquire(self):
+        start = time.perf_counter()
+        self.waiting += 1
+        self.max_waiting = max(self.max_waiting, self.waiting)
+        try:
+            if self._semaphore is not None:
+                await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.wait_seconds += time.perf_counter() - start
+        self.active += 1
+        try:
+            yield
+        finally:
+            self.active -= 1
+            self.completed += 1
+            if self._semaphore is not None:
+                self._semaphore.release()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"name": self.name, "limit": self.limit, "active": self.active, "waiting": self.waiting,
+                "max_waiting": self.max_waiting, "completed": self.completed,
+                "average_wait_seconds": self.wait_seconds / self.completed if self.completed else 0.0}
@@ -0,0 +1,68 @@
+from abc import abstractmethod
+from typing import Any, Dict, List, Optional
+
+
+class BackendError(Exception):
+    """An error returned by a vector store backend.
+
+    `status_code` follows HTTP semantics: None or a 5xx/408/429 code means the backend is unavailable or overloaded and
+    the request may be retried; other codes mean the request itself was rejected.
+    """
+
+    def __init__(self, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class BaseBackend:
+    """ Base class for vector store backends.
+
+    Documents are dictionaries of metadata with an "_id". Their tensor fields are either plain text, embedded by the
+    backend, or custom vectors ({"vector": [...], "content": "..."}, the content being optional) when the field is
+    mapped as {"type": "custom_vector"}.
+    """
+
+    # Whether `search_many` searches several queries faster than one by one.
+    supports_bulk_search = False
+
+    @abstractmethod
+    def index_exists(self, index_name: str) -> bool:
+        """Whether the index exists."""
+
+    @abstractmethod
+    def create_index(self, index_name: str, model: str):
+        """Creates an index whose text is embedded with `model`."""
+
+    @abstractmethod
+    def delete_index(self, index_name: str):
+        """Deletes the index and all of its documents."""
+
+    @abstractmethod
+    def add_documents(self, index_name: str, documents: List[Dict[str, Any]], tensor_fields: List[str],
+                      mappings: Optional[Dict] = None) -> Dict[str, Any]:
+        """Adds or replaces documents by "_id".
+
+        Returns {"errors": bool, "items": [{"_id": ..., "status": ..., "message": ...}, ...]}, where items with a status
+        of 400 or more were rejected without failing the rest of the batch.
+        """
+
+    @abstractmethod
+    def delete_documents(self, index_name: str, ids: List[str]):
+        """Deletes documents by "_id". Unknown IDs are ignored."""
+
+    @abstractmethod
+    def search(self, index_name: str, query: str, limit: int, nprobe: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Returns the metadata of the documents most similar to the query, best first, with their "_score".
+
+        `nprobe` trades recall for latency in approximate indexes: how many partitions of the index are scanned.
+        Backends without such a setting ignore it.
+        """
+
+    def search_many(self, index_name: str, queries: List[str], limit: int,
+                    nprobe: Optional[int] = None) -> List[List[Dict[str, Any]]]:
+        """Like `search`, for several queries at once: the results of each query, in order."""
+        return [self.search(index_name, query, limit, nprobe=nprobe) for query in queries]
+
+    @abstractmethod
+    def embed(self, index_name: str, texts: List[str], content_type: str = "document") -> List[List[float]]:
+        """Embeds texts with the model of the index. `content_type` is "document" or "query"."""
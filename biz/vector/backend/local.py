@@ -0,0 +1,525 @@
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from biz.util.log import logger
+from biz.vector.backend.base import BackendError, BaseBackend
+from biz.vector.backend.quantizer import Quantizer, assign, create_quantizer, kmeans
+
+# Marqo model names -> (Hugging Face model, query prefix, document prefix), so that both backends embed the same way.
+KNOWN_MODELS = {
+    "hf/e5-small-v2": ("intfloat/e5-small-v2", "query: ", "passage: "),
+    "hf/e5-base-v2": ("intfloat/e5-base-v2", "query: ", "passage: "),
+    "hf/e5-large-v2": ("intfloat/e5-large-v2", "query: ", "passage: "),
+}
+
+# Rows scored per NumPy batch, which bounds the memory used by a search.
+SEARCH_BLOCK_ROWS = 65536
+
+# IVF centroids and quantizers are trained once an index has this many documents; until then, searches scan all
+# vectors exactly.
+MIN_TRAIN_ROWS = 4096
+# They are retrained whenever the number of documents has grown this much since the last training.
+RETRAIN_GROWTH = 4
+# Maximum number of vectors sampled for training.
+MAX_TRAIN_SAMPLE = 65536
+# Searches are retried this many times when the index is compacted while they run.
+SEARCH_ATTEMPTS = 3
+
+
+class LoadedIndex(NamedTuple):
+    """What a search needs from an index, as of one generation."""
+
+    generation: int
+    epoch: int  # Row numbers are only valid for this epoch: compaction renumbers them.
+    vectors: Optional[np.ndarray]
+    mask: Optional[np.ndarray]  # Whether each row is a live document.
+    centroids: Optional[np.ndarray]  # IVF only.
+    order: Optional[np.ndarray]  # IVF only: the rows, sorted by inverted list.
+    offsets: Optional[np.ndarray]  # IVF only: where each list starts in `order`.
+    quantizer: Optional[Quantizer]
+    codes: Optional[np.ndarray]  # Quantized only: the codes of all rows, in memory.
+
+
+class LocalIndex:
+    """One index of the local backend, stored in its own directory:
+
+    - settings.json: the model, type and quantization of the index;
+    - vectors.<epoch>.f32: the normalized float32 vectors, one row per document version, appended to as documents are
+      added and memory mapped for search;
+    - metadata.sqlite: the row, "_id" and metadata of each live document, plus the number of rows and dimension of the
+      vectors file. Replaced and deleted documents leave dead rows behind, which are dropped once they outnumber the
+      live ones by writing a new vectors file (a new epoch).
+
+    Vectors are written before the metadata that references them is committed, so other processes (e.g. the chat
+    server while an index is built) always see a consistent index. They reload it when its generation changes.
+
+    A "flat" index scans all vectors on every search. An "ivf" index also clusters the vectors around `nlist` centroids
+    (an inverted file): lists.<version>.i32 holds the list of each row, and searches only score the rows of the
+    `nprobe` lists closest to the query.
+
+    A quantized index ("int8" or "pq") also keeps a compressed code of each row in codes.<version>.u8, loaded in memory.
+    Searches score the candidates approximately from their codes, then re-rank the best `limit * rerank` of them
+    exactly against their full vectors, so only those rows of the vectors file are read from disk.
+
+    Centroids and quantizers are trained once the index has `MIN_TRAIN_ROWS` documents, and retrained whenever it has
+    grown by `RETRAIN_GROWTH` since. Lists and codes are then appended to with the vectors.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, "settings.json"), "r", encoding="utf-8") as f:
+            self.settings = json.load(f)
+        self._connection = sqlite3.connect(os.path.join(path, "metadata.sqlite"), check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS documents (row INTEGER PRIMARY KEY, id TEXT UNIQUE NOT NULL, metadata TEXT)")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value INTEGER)")
+            self._connection.executemany("INSERT OR IGNORE INTO info VALUES (?, ?)",
+                                         [("generation", 0), ("epoch", 0), ("rows", 0), ("dimension", 0),
+                                          ("trained_version", 0), ("trained_rows", 0)])
+            # The IVF centroids and the quantizer, as of the trained version.
+            self._connection.execute("CREATE TABLE IF NOT EXISTS trained (key TEXT PRIMARY KEY, data BLOB)")
+        # (trained version, centroids, quantizer) used to extend the lists and codes of added vectors.
+        self._trained = None
+        self._loaded = None
+
+    @property
+    def model(self) -> str:
+        return self.settings["model"]
+
+    @property
+    def index_type(self) -> str:
+        return self.settings.get("index_type", "flat")
+
+    @property
+    def quantization(self) -> str:
+        return self.settings.get("quantization", "none")
+
+    def _info(self) -> Dict[str, int]:
+        return dict(self._connection.execute("SELECT key, value FROM info").fetchall())
+
+    def _vectors_path(self, epoch: int) -> str:
+        return os.path.join(self.path, f"vectors.{epoch}.f32")
+
+    def _lists_path(self, version: int) -> str:
+        return os.path.join(self.path, f"lists.{version}.i32")
+
+    def _codes_path(self, version: int) -> str:
+        return os.path.join(self.path, f"codes.{version}.u8")
+
+    def _load_trained(self, info: Dict[str, int]) -> Tuple[Optional[np.ndarray], Optional[Quantizer]]:
+        """The centroids and quantizer of the trained version; both None if the index isn't trained yet."""
+        if not info["trained_version"]:
+            return None, None
+        if self._trained is None or self._trained[0] != info["trained_version"]:
+            trained = dict(self._connection.execute("SELECT key, data FROM trained").fetchall())
+            centroids = quantizer = None
+            if "centroids" in trained:
+                centroids = np.frombuffer(trained["centroids"], dtype=np.float32).reshape(-1, info["dimension"])
+            if "quantizer" in trained:
+                quantizer = create_quantizer(self.quantization, info["dimension"], data=trained["quantizer"],
+                                             pq_subvectors=self.settings.get("pq_subvectors"))
+            self._trained = (info["trained_version"], centroids, quantizer)
+        return self._trained[1], self._trained[2]
+
+    def add(self, ids: List[str], metadatas: List[Dict[str, Any]], vectors: np.ndarray):
+        """Appends the vectors, then replaces the documents with the same IDs."""
+        with self._lock:
+            info = self._info()
+            dimension = info["dimension"] or vectors.shape[1]
+            if vectors.shape[1] != dimension:
+                raise BackendError(f"Expected vectors of dimension {dimension}, got {vectors.shape[1]}.", 400)
+            with open(self._vectors_path(info["epoch"]), "ab") as f:
+                f.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+            centroids, quantizer = self._load_trained(info)
+            if centroids is not None:
+                with open(self._lists_path(info["trained_version"]), "ab") as f:
+                    f.write(assign(vectors, centroids).tobytes())
+            if quantizer is not None:
+                with open(self._codes_path(info["trained_version"]), "ab") as f:
+                    f.write(quantizer.encode(vectors).tobytes())
+            rows = range(info["rows"], info["rows"] + len(ids))
+            with self._connection:
+                self._connection.executemany("DELETE FROM documents WHERE id = ?", [(doc_id,) for doc_id in ids])
+                self._connection.executemany(
+                    "INSERT OR REPLACE INTO documents VALUES (?, ?, ?)",
+                    [(row, doc_id, json.dumps(metadata, ensure_ascii=False))
+                     for row, doc_id, metadata in zip(rows, ids, metadatas)])
+                self._connection.executemany("UPDATE info SET value = ? WHERE key = ?",
+                                             [(info["rows"] + len(ids), "rows"), (dimension, "dimension"),
+                                              (info["generation"] + 1, "generation")])
+            self._maybe_compact()
+            self._maybe_train()
+
+    def delete(self, ids: List[str]):
+        with self._lock:
+            with self._connection:
+                self._connection.executemany("DELETE FROM documents WHERE id = ?", [(doc_id,) for doc_id in ids])
+                self._connection.execute("UPDATE info SET value = value + 1 WHERE key = 'generation'")
+            self._maybe_compact()
+
+    def _maybe_compact(self):
+        info = self._info()
+        live = self._connection.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+        dead = info["rows"] - live
+        if dead <= max(live, 1024):
+            return
+
+        live_rows = [row for row, in self._connection.execute("SELECT row FROM documents ORDER BY row")]
+        old_path = self._vectors_path(info["epoch"])
+        new_path = self._vectors_path(info["epoch"] + 1)
+        vectors = np.memmap(old_path, dtype=np.float32, mode="r", shape=(info["rows"], info["dimension"]))
+        with open(new_path, "wb") as f:
+            for start in range(0, len(live_rows), SEARCH_BLOCK_ROWS):
+                f.write(np.ascontiguousarray(vectors[live_rows[start: start + SEARCH_BLOCK_ROWS]]).tobytes())
+        del vectors
+        version = info["trained_version"]
+        centroids, quantizer = self._load_trained(info)
+        if centroids is not None:
+            lists = np.fromfile(self._lists_path(version), dtype=np.int32, count=info["rows"])
+            lists[live_rows].tofile(self._lists_path(version + 1))
+        if quantizer is not None:
+            codes = np.fromfile(self._codes_path(version), dtype=np.uint8, count=info["rows"] * quantizer.code_size())
+            codes.reshape(info["rows"], -1)[live_rows].tofile(self._codes_path(version + 1))
+        with self._connection:
+            # Rows only move down, in ascending order, so the new row numbers never collide with existing ones.
+            self._connection.executemany("UPDATE documents SET row = ? WHERE row = ?",
+                                         [(new_row, row) for new_row, row in enumerate(live_rows) if new_row != row])
+            self._connection.executemany("UPDATE info SET value = ? WHERE key = ?",
+                                         [(len(live_rows), "rows"), (info["epoch"] + 1, "epoch"),
+                                          (version + 1 if version else 0, "trained_version"),
+                                          (info["generation"] + 1, "generation")])
+        # Processes still searching the old files keep their mapping until they reload.
+        os.remove(old_path)
+        self._remove_trained_files(version)
+        logger.info("Compacted local index %s: dropped %d dead vectors.", self.path, dead)
+
+    def _remove_trained_files(self, version: int):
+        for path in (self._lists_path(version), self._codes_path(version)):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _maybe_train(self):
+        if self.index_type != "ivf" and self.quantization == "none":
+            return
+        info = self._info()
+        live = self._connection.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+        if live < max(MIN_TRAIN_ROWS, RETRAIN_GROWTH * info["trained_rows"]):
+            return
+
+        start = time.perf_counter()
+        vectors = np.memmap(self._vectors_path(info["epoch"]), dtype=np.float32, mode="r",
+                            shape=(info["rows"], info["dimension"]))
+        live_rows = np.fromiter((row for row, in self._connection.execute("SELECT row FROM documents")),
+                                dtype=np.int64)
+        rng = np.random.default_rng(0)
+        sample = np.asarray(vectors[np.sort(rng.choice(live_rows, min(live, MAX_TRAIN_SAMPLE), replace=False))])
+        centroids = quantizer = None
+        trained = []
+        if self.index_type == "ivf":
+            nlist = self.settings.get("nlist") or int(np.clip(np.sqrt(live), 16, 16384))
+            centroids = kmeans(sample, min(nlist, len(sample)))
+            trained.append(("centroids", centroids.tobytes()))
+        if self.quantization != "none":
+            quantizer = create_quantizer(self.quantization, info["dimension"], sample=sample,
+                                         pq_subvectors=self.settings.get("pq_subvectors"))
+            trained.append(("quantizer", quantizer.to_bytes()))
+
+        version = info["trained_version"] + 1
+        with open(self._lists_path(version), "wb") as lists, open(self._codes_path(version), "wb") as codes:
+            for block_start in range(0, info["rows"], SEARCH_BLOCK_ROWS):
+                block = np.asarray(vectors[block_start: block_start + SEARCH_BLOCK_ROWS])
+                if centroids is not None:
+                    lists.write(assign(block, centroids).tobytes())
+                if quantizer is not None:
+                    codes.write(quantizer.encode(block).tobytes())
+        del vectors
+        with self._connection:
+            self._connection.execute("DELETE FROM trained")
+            self._connection.executemany("INSERT INTO trained VALUES (?, ?)", trained)
+            self._connection.executemany("UPDATE info SET value = ? WHERE key = ?",
+                                         [(version, "trained_version"), (live, "trained_rows"),
+                                          (info["generation"] + 1, "generation")])
+        self._remove_trained_files(version - 1)
+        logger.info("Trained local index %s (%s, quantization: %s) on %d documents in %.1fs.",
+                    self.path, self.index_type, self.quantization, live, time.perf_counter() - start)
+
+    def _load(self) -> LoadedIndex:
+        """The search structures of the current generation, reloaded only when the index changed."""
+        with self._lock:
+            # A single read transaction, so the rows, epoch, trained version and live documents are consistent.
+            with self._connection:
+                self._connection.execute("BEGIN")
+                info = self._info()
+                if self._loaded is not None and self._loaded.generation == info["generation"]:
+                    return self._loaded
+                live_rows = np.fromiter((row for row, in self._connection.execute("SELECT row FROM documents")),
+                                        dtype=np.int64)
+                centroids, quantizer = self._load_trained(info)
+            vectors = mask = order = offsets = codes = None
+            if info["rows"]:
+                vectors = np.memmap(self._vectors_path(info["epoch"]), dtype=np.float32, mode="r",
+                                    shape=(info["rows"], info["dimension"]))
+                mask = np.zeros(info["rows"], dtype=bool)
+                mask[live_rows] = True
+                if centroids is not None:
+                    lists = np.fromfile(self._lists_path(info["trained_version"]), dtype=np.int32,
+                                        count=info["rows"])
+                    order = np.argsort(lists, kind="stable")
+                    offsets = np.searchsorted(lists[order], np.arange(len(centroids) + 1))
+                if quantizer is not None:
+                    codes = np.fromfile(self._codes_path(info["trained_version"]), dtype=np.uint8,
+                                        count=info["rows"] * quantizer.code_size()).reshape(info["rows"], -1)
+            self._loaded = LoadedIndex(info["generation"], info["epoch"], vectors, mask, centroids, order, offsets, quantizer, codes)
+            return self._loaded
+
+    def memory_bytes(self) -> int:
+        """Memory used by the search structures: the codes of a quantized index (or the vectors, which every search
+        reads entirely otherwise), the inverted lists and the live row mask."""
+        loaded = self._load()
+        arrays = [loaded.mask, loaded.centroids, loaded.order, loaded.offsets]
+        arrays.append(loaded.codes if loaded.quantizer is not None else loaded.vectors)
+        return sum(array.nbytes for array in arrays if array is not None)
+
+    def search(self, query_vector: np.ndarray, limit: int, nprobe: Optional[int] = None,
+               rerank: int = 10) -> List[Dict[str, Any]]:
+        """The documents most similar to the query vector.
+
+        Args:
+            nprobe: How many inverted lists an IVF index scans. More lists give a better recall but a slower search;
+                None scans all vectors.
+            rerank: For quantized indexes, how many candidates per result are re-ranked with their exact score.
+        """
+        for _ in range(SEARCH_ATTEMPTS):
+            try:
+                loaded = self._load()
+            except FileNotFoundError:
+                # The index was compacted or retrained between reading its metadata and opening its files.
+                loaded = self._load()
+            if loaded.vectors is None:
+                return []
+            rows, scores = self._top(loaded, query_vector, limit, nprobe, rerank)
+            found = self._documents(loaded.epoch, rows)
+            if found is None:
+                # Compacted since it was loaded: the rows now belong to other documents.
+                continue
+            hits = []
+            for row, score in zip(rows, scores):
+                # Skip documents replaced or deleted since the index was loaded.
+                if row in found:
+                    hit = json.loads(found[row])
+                    hit["_score"] = score
+                    hits.append(hit)
+            return hits
+        logger.warning("Local index %s was compacted during %d attempts to search it.", self.path, SEARCH_ATTEMPTS)
+        return []
+
+    @staticmethod
+    def _top(loaded: LoadedIndex, query_vector: np.ndarray, limit: int, nprobe: Optional[int],
+             rerank: int) -> Tuple[List[int], List[float]]:
+        """The rows of the best scoring documents of a loaded index, best first, and their scores."""
+        # Candidate rows; None stands for all live rows.
+        rows = None
+        if loaded.centroids is not None and nprobe is not None and nprobe < len(loaded.centroids):
+            nprobe = max(nprobe, 1)
+            probed = np.argpartition(-(loaded.centroids @ query_vector), nprobe - 1)[:nprobe]
+            rows = np.concatenate([loaded.order[loaded.offsets[i]: loaded.offsets[i + 1]] for i in probed])
+            rows = rows[loaded.mask[rows]]
+        if loaded.quantizer is not None:
+            if rows is None:
+                rows = np.flatnonzero(loaded.mask)
+                approximate_scores = loaded.quantizer.scores(loaded.codes, query_vector)[rows]
+            else:
+                approximate_scores = loaded.quantizer.scores(loaded.codes[rows], query_vector)
+            keep = limit * max(rerank, 1)
+            if keep < len(rows):
+                rows = rows[np.argpartition(-approximate_scores, keep - 1)[:keep]]
+
+        if rows is None:
+            rows = np.flatnonzero(loaded.mask)
+            scores = np.empty(len(loaded.vectors), dtype=np.float32)
+            for start in range(0, len(loaded.vectors), SEARCH_BLOCK_ROWS):
+                scores[start: start + SEARCH_BLOCK_ROWS] = \
+                    loaded.vectors[start: start + SEARCH_BLOCK_ROWS] @ query_vector
+            scores = scores[rows]
+        else:
+            # Sorted rows read the memory map sequentially.
+            rows = np.sort(rows)
+            scores = loaded.vectors[rows] @ query_vector
+
+        limit = min(limit, len(rows))
+        if limit <= 0:
+            return [], []
+        top = np.argpartition(-scores, limit - 1)[:limit]
+        top = top[np.argsort(-scores[top])]
+        return [int(rows[i]) for i in top], [float(scores[i]) for i in top]
+
+    def _documents(self, epoch: int, rows: List[int]) -> Optional[Dict[int, str]]:
+        """The metadata of the live documents among the rows, or None if the index isn't at that epoch anymore."""
+        if not rows:
+            return {}
+        with self._lock:
+            # The epoch and the documents are read in the same transaction, so a compaction can't come in between.
+            with self._connection:
+                self._connection.execute("BEGIN")
+                if self._info()["epoch"] != epoch:
+                    return None
+                placeholders = ",".join("?" * len(rows))
+                return dict(self._connection.execute(
+                    f"SELECT row, metadata FROM documents WHERE row IN ({placeholders})", rows).fetchall())
+
+    def close(self):
+        with self._lock:
+            self._loaded = None
+            self._connection.close()
+
+
+class LocalBackend(BaseBackend):
+    """In-process vector store over memory-mapped vectors, without any external service (see `LocalIndex`).
+
+    Text is embedded with sentence-transformers (an optional dependency, only imported when something needs to be
+    embedded), using the same models and prefixes as Marqo.
+    """
+
+    supports_bulk_search = True
+
+    def __init__(self, data_dir: str, device: Optional[str] = None, index_type: str = "flat",
+                 nlist: Optional[int] = None, nprobe: int = 16, quantization: str = "none",
+                 pq_subvectors: Optional[int] = None, rerank: int = 10):
+        """
+        Args:
+            index_type: Type of the indexes created: "flat" (exact search) or "ivf" (approximate search, for large
+                indexes). Existing indexes keep the type and quantization they were created with.
+            nlist: Number of inverted lists of IVF indexes; by default, the square root of the number of documents.
+            nprobe: Default number of inverted lists scanned by a search of an IVF index.
+            quantization: Compression of the vectors searched in memory: "none", "int8" (4x smaller) or "pq" (product
+                quantization, 32x smaller by default). Full vectors stay on disk to re-rank the best candidates.
+            pq_subvectors: Bytes per vector with product quantization; by default, one per 8 dimensions.
+            rerank: Candidates re-ranked exactly per result, for quantized indexes.
+        """
+        if index_type not in ("flat", "ivf"):
+            raise ValueError(f"Unknown local index type: {index_type}")
+        if quantization not in ("none", "int8", "pq"):
+            raise ValueError(f"Unknown local quantization: {quantization}")
+        self.data_dir = data_dir
+        self.device = device
+        self.index_type = index_type
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.quantization = quantization
+        self.pq_subvectors = pq_subvectors
+        self.rerank = rerank
+        self._indexes = {}
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def _index_path(self, index_name: str) -> str:
+        return os.path.join(self.data_dir, index_name)
+
+    def _index(self, index_name: str) -> LocalIndex:
+        with self._lock:
+            if index_name not in self._indexes:
+                if not self.index_exists(index_name):
+                    raise BackendError(f"Index {index_name} not found.", 404)
+                self._indexes[index_name] = LocalIndex(self._index_path(index_name))
+            return self._indexes[index_name]
+
+    def _model(self, model: str):
+        with self._lock:
+            if model not in self._models:
+                try:
+                    from sentence_transformers import SentenceTransformer
+                except ImportError as e:
+                    raise ImportError("The local vector backend needs sentence-transformers to embed text: "
+                                      "pip install sentence-transformers") from e
+                model_name = KNOWN_MODELS.get(model, (model.removeprefix("hf/"),))[0]
+                logger.info(f"正在加载嵌入模型 {model_name}...")
+                self._models[model] = SentenceTransformer(model_name, device=self.device)
+            return self._models[model]
+
+    def _embed(self, model: str, texts: List[str], content_type: str) -> np.ndarray:
+        _, query_prefix, document_prefix = KNOWN_MODELS.get(model, (None, "", ""))
+        prefix = query_prefix if content_type == "query" else document_prefix
+        return self._model(model).encode([prefix + text for text in texts], normalize_embeddings=True,
+                                         convert_to_numpy=True).astype(np.float32)
+
+    def index_exists(self, index_name: str) -> bool:
+        return os.path.exists(os.path.join(self._index_path(index_name), "settings.json"))
+
+    def create_index(self, index_name: str, model: str):
+        path = self._index_path(index_name)
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, "settings.json"), "w", encoding="utf-8") as f:
+            json.dump({"model": model, "index_type": self.index_type, "nlist": self.nlist,
+                       "quantization": self.quantization, "pq_subvectors": self.pq_subvectors}, f)
+
+    def delete_index(self, index_name: str):
+        with self._lock:
+            index = self._indexes.pop(index_name, None)
+        if index is not None:
+            index.close()
+        shutil.rmtree(self._index_path(index_name), ignore_errors=True)
+
+    def add_documents(self, index_name: str, documents: List[Dict[str, Any]], tensor_fields: List[str],
+                      mappings: Optional[Dict] = None) -> Dict[str, Any]:
+        index = self._index(index_name)
+        mappings = mappings or {}
+        items, ids, metadatas, vectors, texts = [], [], [], [], []
+        for document in documents:
+            doc_id = document.get("_id")
+            # The first tensor field of the document is the one embedded.
+            field = next((field for field in tensor_fields if field in document), None)
+            if not isinstance(doc_id, str) or not doc_id or field is None:
+                items.append({"_id": doc_id, "status": 400, "message": "Documents need an _id and a tensor field."})
+                continue
+            metadata = dict(document)
+            value = document[field]
+            if mappings.get(field, {}).get("type") == "custom_vector":
+                metadata[field] = value.get("content", "")
+                vectors.append(value["vector"])
+            else:
+                texts.append(value)
+                vectors.append(None)
+            ids.append(doc_id)
+            metadatas.append(metadata)
+            items.append({"_id": doc_id, "status": 200})
+
+        if ids:
+            if texts:
+                embedded = iter(self._embed(index.model, texts, "document"))
+                vectors = [next(embedded) if vector is None else vector for vector in vectors]
+            try:
+                matrix = np.asarray(vectors, dtype=np.float32)
+            except ValueError as e:
+                raise BackendError(f"Invalid vectors: {e}", 400) from e
+            # Scores are cosine similarities, as with Marqo's default distance metric.
+            matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+            index.add(ids, metadatas, matrix)
+        return {"errors": any(item["status"] >= 400 for item in items), "items": items}
+
+    def delete_documents(self, index_name: str, ids: List[str]):
+        self._index(index_name).delete(ids)
+
+    def search(self, index_name: str, query: str, limit: int, nprobe: Optional[int] = None) -> List[Dict[str, Any]]:
+        index = self._index(index_name)
+        return index.search(self._embed(index.model, [query], "query")[0], limit, nprobe=nprobe or self.nprobe,
+                            rerank=self.rerank)
+
+    def search_many(self, index_name: str, queries: List[str], limit: int,
+                    nprobe: Optional[int] = None) -> List[List[Dict[str, Any]]]:
+        # Queries are embedded in one batch, which is most of the cost of a search.
+        index = self._index(index_name)
+        return [index.search(query_vector, limit, nprobe=nprobe or self.nprobe, rerank=self.rerank)
+                for query_vector in self._embed(index.model, queries, "query")]
+
+    def embed(self, index_name: str, texts: List[str], content_type: str = "document") -> List[List[float]]:
+        return self._embed(self._index(index_name).model, texts, content_type).tolist()
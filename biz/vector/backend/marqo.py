@@ -0,0 +1,105 @@
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import marqo
+from marqo import _httprequests
+from marqo.errors import MarqoError, MarqoWebError
+from requests.adapters import HTTPAdapter
+
+from biz.vector.backend.base import BackendError, BaseBackend
+
+
+class MarqoBackend(BaseBackend):
+    """Vector store backed by a Marqo server.
+
+    Meant to be long-lived and shared: it keeps index handles (each of which checks the server version when created)
+    and the list of index names, so that a search is a single request to the server.
+    """
+
+    # Marqo 2 servers no longer have the bulk search endpoint of the client; several queries are searched concurrently
+    # instead (see `VectorStore.search_many`), over the pooled connections.
+    supports_bulk_search = False
+
+    def __init__(self, url: str, pool_size: int = 16, catalog_ttl: float = 60):
+        """
+        Args:
+            pool_size: Keep-alive connections kept open to the server, at least as many as concurrent requests.
+            catalog_ttl: Seconds for which the list of index names is trusted. Indexes created or deleted through this
+                backend update it right away; the TTL only bounds how long changes made elsewhere go unnoticed.
+        """
+        self.client = marqo.Client(url=url)
+        # The Marqo client sends every request through one module-level session, whose default pool only keeps 10
+        # connections alive.
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        _httprequests.session.mount("http://", adapter)
+        _httprequests.session.mount("https://", adapter)
+        self.catalog_ttl = catalog_ttl
+        self._indexes = {}
+        self._catalog = None
+        self._catalog_time = 0.0
+        self._lock = threading.Lock()
+
+    def _index(self, index_name: str) -> marqo.index.Index:
+        with self._lock:
+            if index_name not in self._indexes:
+                self._indexes[index_name] = self.client.index(index_name)
+            return self._indexes[index_name]
+
+    def _index_names(self) -> set:
+        with self._lock:
+            if self._catalog is not None and time.monotonic() - self._catalog_time < self.catalog_ttl:
+                return self._catalog
+        # Get the list of all indexes
+        names = {index["indexName"] for index in self.client.get_indexes()["results"]}
+        with self._lock:
+            self._catalog, self._catalog_time = names, time.monotonic()
+        return names
+
+    def index_exists(self, index_name: str) -> bool:
+        try:
+            return index_name in self._index_names()
+        except (MarqoError, MarqoWebError):
+            # If an error occurs when listing indexes, consider that the index doesn't exist
+            return False
+
+    def create_index(self, index_name: str, model: str):
+        try:
+            self.client.create_index(index_name, model=model)
+        finally:
+            self._invalidate(index_name)
+
+    def delete_index(self, index_name: str):
+        try:
+            self.client.delete_index(index_name)
+        finally:
+            self._invalidate(index_name)
+
+    def _invalidate(self, index_name: str):
+        with self._lock:
+            self._catalog = None
+            self._indexes.pop(index_name, None)
+
+    def add_documents(self, index_name: str, documents: List[Dict[str, Any]], tensor_fields: List[str],
+                      mappings: Optional[Dict] = None) -> Dict[str, Any]:
+        try:
+            return self._index(index_name).add_documents(documents=documents, tensor_fields=tensor_fields,
+                                                         mappings=mappings)
+        except (MarqoError, MarqoWebError) as e:
+            raise BackendError(str(e), status_code=getattr(e, "status_code", None)) from e
+
+    def delete_documents(self, index_name: str, ids: List[str]):
+        try:
+            self._index(index_name).delete_documents(ids=ids)
+        except (MarqoError, MarqoWebError) as e:
+            raise BackendError(str(e), status_code=getattr(e, "status_code", None)) from e
+
+    def search(self, index_name: str, query: str, limit: int, nprobe: Optional[int] = None) -> List[Dict[str, Any]]:
+        # Marqo's HNSW index is tuned on the server; nprobe doesn't apply.
+        return self._index(index_name).search(q=query, limit=limit)["hits"]
+
+    def embed(self, index_name: str, texts: List[str], content_type: str = "document") -> List[List[float]]:
+        try:
+            return self._index(index_name).embed(content=texts, content_type=content_type)["embeddings"]
+        except (MarqoError, MarqoWebError) as e:
+            raise BackendError(str(e), status_code=getattr(e, "status_code", None)) from e
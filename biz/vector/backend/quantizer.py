@@ -0,0 +1,169 @@
+"""Vector clustering and compression for the local vector backend."""
+
+from abc import ABC, abstractmethod
+from typing import Optional
+
+import numpy as np
+
+# Rows processed per NumPy batch, which bounds the memory used while assigning or encoding vectors.
+BLOCK_ROWS = 65536
+KMEANS_ITERATIONS = 10
+
+
+def assign(vectors: np.ndarray, centroids: np.ndarray, spherical: bool = True) -> np.ndarray:
+    """The closest centroid of each vector: by cosine similarity if `spherical`, otherwise by Euclidean distance."""
+    # argmin |x - c|^2 = argmax (x.c - |c|^2 / 2)
+    offsets = 0 if spherical else (centroids * centroids).sum(axis=1) / 2
+    labels = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), BLOCK_ROWS):
+        labels[start: start + BLOCK_ROWS] = np.argmax(vectors[start: start + BLOCK_ROWS] @ centroids.T - offsets,
+                                                      axis=1)
+    return labels
+
+
+def kmeans(sample: np.ndarray, k: int, spherical: bool = True, seed: int = 0) -> np.ndarray:
+    """Trains k centroids on a sample. Spherical centroids are normalized, for vectors compared by cosine similarity."""
+    rng = np.random.default_rng(seed)
+    centroids = sample[rng.choice(len(sample), k, replace=False)].astype(np.float32)
+    for _ in range(KMEANS_ITERATIONS):
+        labels = assign(sample, centroids, spherical)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, sample)
+        counts = np.bincount(labels, minlength=k)
+        # Empty clusters restart from a random vector.
+        empty = counts == 0
+        sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+        counts[empty] = 1
+        if spherical:
+            centroids = sums / np.maximum(np.linalg.norm(sums, axis=1, keepdims=True), 1e-12)
+        else:
+            centroids = sums / counts[:, None]
+    return centroids.astype(np.float32)
+
+
+class Quantizer(ABC):
+    """Compresses vectors into fixed-size codes, whose scores against a query approximate the exact dot products."""
+
+    @abstractmethod
+    def code_size(self) -> int:
+        """Bytes per vector."""
+
+    @abstractmethod
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        """The (len(vectors), code_size) uint8 codes of the vectors."""
+
+    @abstractmethod
+    def scores(self, codes: np.ndarray, query: np.ndarray) -> np.ndarray:
+        """Approximate dot products of the query with the encoded vectors."""
+
+    @abstractmethod
+    def to_bytes(self) -> bytes:
+        """The trained parameters, to load the quantizer back with `create_quantizer`."""
+
+
+def create_quantizer(quantization: str, dimension: int, data: Optional[bytes] = None,
+                     sample: Optional[np.ndarray] = None, pq_subvectors: Optional[int] = None) -> Quantizer:
+    """Loads a quantizer from its bytes, or trains one on a sample.
+
+    Args:
+        quantization: "int8" or "pq".
+        pq_subvectors: Parts of product quantized vectors; by default, one per 8 dimensions.
+    """
+    if quantization == "int8":
+        return ScalarQuantizer.from_bytes(data) if data is not None else ScalarQuantizer.train(sample)
+    if quantization == "pq":
+        # 8 dimensions per part, or the largest divisor of the dimension below that.
+        subvectors = pq_subvectors or dimension // next(size for size in range(8, 0, -1) if dimension % size == 0)
+        if data is not None:
+            return ProductQuantizer.from_bytes(data, dimension, subvectors)
+        return ProductQuantizer.train(sample, subvectors)
+    raise ValueError(f"Unknown quantization: {quantization}")
+
+
+class ScalarQuantizer(Quantizer):
+    """int8 codes: each dimension is scaled so that the largest absolute value seen in training maps to 127.
+
+    4x smaller than float32, with scores close enough to rank candidates reliably.
+    """
+
+    def __init__(self, scales: np.ndarray):
+        self.scales = scales.astype(np.float32)
+
+    @classmethod
+    def train(cls, sample: np.ndarray) -> "ScalarQuantizer":
+        return cls(np.maximum(np.abs(sample).max(axis=0), 1e-12) / 127)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "ScalarQuantizer":
+        return cls(np.frombuffer(data, dtype=np.float32))
+
+    def to_bytes(self) -> bytes:
+        return self.scales.tobytes()
+
+    def code_size(self) -> int:
+        return len(self.scales)
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        return np.clip(np.rint(vectors / self.scales), -127, 127).astype(np.int8).view(np.uint8)
+
+    def scores(self, codes: np.ndarray, query: np.ndarray) -> np.ndarray:
+        scaled_query = query * self.scales
+        scores = np.empty(len(codes), dtype=np.float32)
+        for start in range(0, len(codes), BLOCK_ROWS):
+            scores[start: start + BLOCK_ROWS] = \
+                codes[start: start + BLOCK_ROWS].view(np.int8).astype(np.float32) @ scaled_query
+        return scores
+
+
+class ProductQuantizer(Quantizer):
+    """Product quantization: vectors are split into `subvectors` parts, each encoded as the index of the closest of 256
+    centroids trained for that part. One byte per part, e.g. 96 bytes instead of 3 KB for 768 float32 dimensions.
+
+    A query is scored against all centroids of each part once; the score of a code is then the sum of the table
+    entries it selects (asymmetric distance computation).
+    """
+
+    def __init__(self, codebooks: np.ndarray):
+        # (subvectors, 256, dimension / subvectors)
+        self.codebooks = codebooks.astype(np.float32)
+
+    @classmethod
+    def train(cls, sample: np.ndarray, subvectors: int) -> "ProductQuantizer":
+        dimension = sample.shape[1]
+        if dimension % subvectors:
+            raise ValueError(f"The dimension {dimension} isn't a multiple of the number of subvectors {subvectors}.")
+        size = dimension // subvectors
+        codebooks = np.zeros((subvectors, 256, size), dtype=np.float32)
+        k = min(256, len(sample))
+        for part in range(subvectors):
+            codebooks[part, :k] = kmeans(np.ascontiguousarray(sample[:, part * size: (part + 1) * size]), k,
+                                         spherical=False, seed=part)
+        return cls(codebooks)
+
+    @classmethod
+    def from_bytes(cls, data: bytes, dimension: int, subvectors: int) -> "ProductQuantizer":
+        return cls(np.frombuffer(data, dtype=np.float32).reshape(subvectors, 256, dimension // subvectors))
+
+    def to_bytes(self) -> bytes:
+        return self.codebooks.tobytes()
+
+    def code_size(self) -> int:
+        return len(self.codebooks)
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        subvectors, _, size = self.codebooks.shape
+        codes = np.empty((len(vectors), subvectors), dtype=np.uint8)
+        for part in range(subvectors):
+            codes[:, part] = assign(np.ascontiguousarray(vectors[:, part * size: (part + 1) * size]),
+                                    self.codebooks[part], spherical=False)
+        return codes
+
+    def scores(self, codes: np.ndarray, query: np.ndarray) -> np.ndarray:
+        subvectors, _, size = self.codebooks.shape
+        # Dot product of each part of the query with each centroid of that part.
+        table = np.einsum("pkd,pd->pk", self.codebooks, query.reshape(subvectors, size))
+        parts = np.arange(subvectors)
+        scores = np.empty(len(codes), dtype=np.float32)
+        for start in range(0, len(codes), BLOCK_ROWS):
+            scores[start: start + BLOCK_ROWS] = table[parts, codes[start: start + BLOCK_ROWS]].sum(axis=1)
+        return scores
@@ -0,0 +1,91 @@
+"""Compares the recall, latency and memory of IVF searches and quantized vectors with flat scans on the local vector
+backend.
+
+    python -m biz.vector.benchmark --documents 200000 --nprobe 4 8 16 32 --quantization none int8 pq
+
+Vectors are synthetic: clustered like embeddings of related code, and normalized. The exact top k of a flat scan is the
+ground truth of recall@k. Memory is what searches keep in RAM: the vectors, or their codes once quantized, plus the
+inverted lists.
+"""
+
+import argparse
+import tempfile
+import time
+
+import numpy as np
+
+from biz.vector.backend.local import LocalBackend
+
+
+def make_vectors(count: int, dimension: int, clusters: int, rng: np.random.Generator) -> np.ndarray:
+    centers = rng.standard_normal((clusters, dimension)).astype(np.float32)
+    vectors = centers[rng.integers(clusters, size=count)] + rng.standard_normal((count, dimension)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def build(backend: LocalBackend, index_name: str, vectors: np.ndarray, batch_size: int = 1000) -> float:
+    backend.create_index(index_name, model="none")
+    start = time.perf_counter()
+    for i in range(0, len(vectors), batch_size):
+        documents = [{"_id": str(row), "text": {"vector": vectors[row].tolist()}}
+                     for row in range(i, min(i + batch_size, len(vectors)))]
+        backend.add_documents(index_name, documents, tensor_fields=["text"],
+                              mappings={"text": {"type": "custom_vector"}})
+    return time.perf_counter() - start
+
+
+def run_queries(backend: LocalBackend, index_name: str, queries: np.ndarray, top_k: int, nprobe):
+    index = backend._index(index_name)
+    results, latencies = [], []
+    for query in queries:
+        start = time.perf_counter()
+        hits = index.search(query, top_k, nprobe=nprobe, rerank=backend.rerank)
+        latencies.append(time.perf_counter() - start)
+        results.append({hit["_id"] for hit in hits})
+    return results, np.array(latencies) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--documents", type=int, default=100000)
+    parser.add_argument("--dimension", type=int, default=768)
+    parser.add_argument("--clusters", type=int, default=1000, help="Clusters of the synthetic vectors.")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--nlist", type=int, default=None, help="IVF lists; by default sqrt(documents).")
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 8, 16, 32, 64])
+    parser.add_argument("--quantization", nargs="+", default=["none", "int8", "pq"], choices=["none", "int8", "pq"])
+    parser.add_argument("--rerank", type=int, default=10, help="Candidates re-ranked per result when quantized.")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    vectors = make_vectors(args.documents, args.dimension, args.clusters, rng)
+    # Queries are close to, but not exactly, indexed vectors.
+    queries = vectors[rng.integers(args.documents, size=args.queries)]
+    queries = queries + 0.5 * make_vectors(args.queries, args.dimension, args.clusters, rng)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        print(f"Indexing {args.documents} vectors of dimension {args.dimension}...")
+        backends = {}
+        for index_type in ("flat", "ivf"):
+            for quantization in dict.fromkeys(["none"] + args.quantization):
+                name = f"{index_type}-{quantization}"
+                backends[name] = LocalBackend(data_dir, index_type=index_type, nlist=args.nlist,
+                                              quantization=quantization, rerank=args.rerank)
+                print(f"{name}: built in {build(backends[name], name, vectors):.1f}s")
+
+        truth, _ = run_queries(backends["flat-none"], "flat-none", queries, args.top_k, nprobe=None)
+        print(f"\n{'search':<24}{'recall@' + str(args.top_k):>10}{'p50 ms':>10}{'p99 ms':>10}{'memory MB':>12}")
+        for name, backend in backends.items():
+            memory = backend._index(name).memory_bytes() / 2 ** 20
+            for nprobe in (args.nprobe if name.startswith("ivf") else [None]):
+                results, latencies = run_queries(backend, name, queries, args.top_k, nprobe=nprobe)
+                recall = np.mean([len(result & expected) / len(expected) for result, expected in zip(results, truth)])
+                label = name if nprobe is None else f"{name} nprobe={nprobe}"
+                print(f"{label:<24}{recall:>10.3f}{np.percentile(latencies, 50):>10.2f}"
+                      f"{np.percentile(latencies, 99):>10.2f}{memory:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
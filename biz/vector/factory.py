@@ -0,0 +1,24 @@
+import os
+
+from biz.vector.backend.base import BaseBackend
+from biz.vector.backend.local import LocalBackend
+from biz.vector.backend.marqo import MarqoBackend
+
+
+class BackendFactory:
+    @staticmethod
+    def getBackend(provider: str = None) -> BaseBackend:
+        provider = provider or os.getenv("VECTOR_BACKEND", "marqo")
+        vector_backends = {
+            'marqo': lambda: MarqoBackend(url=os.getenv('MARQO_BASE_URL', 'http://localhost:8882')),
+            'local': lambda: LocalBackend(data_dir=os.getenv('LOCAL_VECTOR_DIR', 'data/vectors'),
+                                          index_type=os.getenv('LOCAL_INDEX_TYPE', 'flat'),
+                                          nprobe=int(os.getenv('LOCAL_IVF_NPROBE', 16)),
+                                          quantization=os.getenv('LOCAL_QUANTIZATION', 'none')),
+        }
+
+        backend_func = vector_backends.get(provider)
+        if backend_func:
+            return backend_func()
+        else:
+            raise Exception(f'Unknown vector backend: {provider}')
@@ -1,7 +1,17 @@
+import asyncio
+import time
 from abc import ABC
-from typing import Dict, Generator, List, Tuple, Any, Optional
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Dict, Generator, List, NamedTuple, Tuple, Any, Optional
 
-import marqo
+from biz.lexical_index import LexicalIndex, capitalized_words, identifiers
+from biz.repo_snapshot import RepoSnapshot
+from biz.retrieval_cache import IndexGenerations, RetrievalCache
+from biz.util.log import logger
+from biz.vector.backend.base import BaseBackend
+
+# Reciprocal-rank fusion constant: a document ranked r-th by a retriever scores 1 / (RRF_K + r).
+RRF_K = 60
 
 
 class Document:
@@ -10,49 +20,283 @@ class Document:
         self.metadata = metadata
 
 
+class SearchResult(NamedTuple):
+    """The documents found for one query of `VectorStore.search_many`, and how long the search took."""
+
+    query: str
+    documents: List[Document]
+    seconds: float
+
+
 class VectorStore(ABC):
-    def __init__(self, url: str, index_name: str = None):
-        self.client = marqo.Client(url=url)
+    def __init__(self, backend: BaseBackend, index_name: str = None, snapshot: Optional[RepoSnapshot] = None,
+                 cache: Optional[RetrievalCache] = None, generations: Optional[IndexGenerations] = None,
+                 lexical_index: Optional[LexicalIndex] = None, hybrid_candidates: int = 2, search_workers: int = 8):
+        """
+        :param backend: The vector store backend holding the indexes (see `biz.vector.factory.BackendFactory`).
+        :param snapshot: Reads back the text of chunks indexed without it (see `Embedder`'s store_text).
+        :param cache: Caches search results per (index, generation, query, top_k, nprobe).
+        :param generations: The generation of each index, which invalidates its cached results when it changes.
+        :param lexical_index: Keyword index built along the vector index (see `Embedder`). Indexes that have one are
+            searched both ways concurrently, and the results are merged by reciprocal-rank fusion. Its symbol table
+            also returns the chunks defining the identifiers named in a query, ahead of the other results.
+        :param hybrid_candidates: In hybrid searches, each retriever returns top_k times this many candidates.
+        :param search_workers: How many indexes each call of `search_indexes` searches concurrently, and by default how
+            many queries `search_many` searches concurrently.
+        """
+        self.backend = backend
         self.index_name = index_name
+        self.snapshot = snapshot
+        self.cache = cache
+        self.generations = generations
+        self.lexical_index = lexical_index
+        self.hybrid_candidates = hybrid_candidates
+        self._executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="lexical") if lexical_index else None
+        self.search_workers = search_workers
+
+    def search(self, query: str, top_k: int = 5, index_name: Optional[str] = None,
+               nprobe: Optional[int] = None) -> list:
+        """
+        Perform a search on the index and return a list of documents.
+
+        :param nprobe: For approximate indexes, how many partitions are scanned: higher is slower but more accurate.
+            Defaults to the backend's setting.
+        """
+        search_index = index_name if index_name is not None else self.index_name
+        key = self._cache_key(search_index, query, top_k, nprobe)
+        cached = self._cached(key)
+        if cached is not None:
+            return cached
 
-    def search(self, query: str, top_k: int = 5, index_name: Optional[str] = None) -> list:
+        # Chunks defining identifiers named in the query come first; similar chunks fill the remaining places.
+        results = self._find_definitions(search_index, query, top_k)
+        if len(results) < top_k:
+            if self.lexical_index is not None and self.lexical_index.exists(search_index):
+                similar = self._hybrid_search(search_index, query, top_k, nprobe)
+            else:
+                similar = self.backend.search(search_index, query=query, limit=top_k, nprobe=nprobe)
+            found = {result["_id"] for result in results}
+            results.extend([result for result in similar if result["_id"] not in found][:top_k - len(results)])
+        return self._documents(results, key)
+
+    def search_many(self, queries: List[str], top_k: int = 5, index_name: Optional[str] = None,
+                    nprobe: Optional[int] = None, workers: Optional[int] = None) -> List[SearchResult]:
         """
-        Perform a search on the Marqo index and return a list of documents.
+        Search several queries on one index, e.g. to evaluate retrieval on a set of questions.
+
+        Indexes searched by vector only use the backend's bulk search if it has one (see `BaseBackend.search_many`), for
+        the queries that aren't cached. Otherwise, queries are searched like `search`, `workers` at a time (by default,
+        `search_workers`).
+
+        :return: The results of each query, in the order of `queries`, with the seconds it took. Queries searched in
+            bulk share the time of the bulk search equally.
         """
         search_index = index_name if index_name is not None else self.index_name
-        results = self.client.index(search_index).search(
-            q=query,
-            limit=top_k
-        )
+        hybrid = self.lexical_index is not None and self.lexical_index.exists(search_index)
+        if not self.backend.supports_bulk_search or hybrid:
+            def timed_search(query: str) -> SearchResult:
+                start = time.perf_counter()
+                documents = self.search(query, top_k=top_k, index_name=search_index, nprobe=nprobe)
+                return SearchResult(query, documents, time.perf_counter() - start)
+
+            with ThreadPoolExecutor(max_workers=workers or self.search_workers,
+                                    thread_name_prefix="search-many") as executor:
+                return list(executor.map(timed_search, queries))
+
+        results = [None] * len(queries)
+        keys = [self._cache_key(search_index, query, top_k, nprobe) for query in queries]
+        misses = []
+        for i, key in enumerate(keys):
+            start = time.perf_counter()
+            cached = self._cached(key)
+            if cached is None:
+                misses.append(i)
+            else:
+                results[i] = SearchResult(queries[i], cached, time.perf_counter() - start)
+        if misses:
+            start = time.perf_counter()
+            bulk_results = self.backend.search_many(search_index, [queries[i] for i in misses], limit=top_k,
+                                                    nprobe=nprobe)
+            documents = [self._documents(query_results, keys[i]) for i, query_results in zip(misses, bulk_results)]
+            seconds = (time.perf_counter() - start) / len(misses)
+            for i, query_documents in zip(misses, documents):
+                results[i] = SearchResult(queries[i], query_documents, seconds)
+        return results
+
+    def _cache_key(self, index_name: str, query: str, top_k: int, nprobe: Optional[int]) -> Optional[Tuple]:
+        if self.cache is None:
+            return None
+        generation = self.generations.get(index_name) if self.generations is not None else 0
+        return index_name, generation, query, top_k, nprobe
 
+    def _cached(self, key: Optional[Tuple]) -> Optional[List[Document]]:
+        cached = self.cache.get(key) if key is not None else None
+        if cached is None:
+            return None
+        # Copies, since callers may modify the documents they get.
+        return [Document(page_content=doc.page_content, metadata=dict(doc.metadata)) for doc in cached]
+
+    def _documents(self, results: List[Dict[str, Any]], key: Optional[Tuple]) -> List[Document]:
+        """Turns search hits into documents, reading the text of position-only chunks, and caches them under `key`."""
         documents = []
-        for result in results["hits"]:
+        for result in results:
             content = result.pop("text")
+            if "commit" in result and self.snapshot is not None:
+                # The chunk was indexed by position only; read its text from the repository.
+                content = self.snapshot.chunk_content(result["file_path"], result["commit"], result["start_byte"],
+                                                      result["end_byte"]) or content
             documents.append(Document(page_content=content, metadata=result))
+
+        if key is not None:
+            size = sum(len(doc.page_content) + len(str(doc.metadata)) for doc in documents) + len(key[2])
+            self.cache.put(key, [Document(page_content=doc.page_content, metadata=dict(doc.metadata))
+                                 for doc in documents], size)
         return documents
 
+    def search_indexes(self, query: str, index_names: List[str], top_k: int = 5, timeout: Optional[float] = None,
+                       nprobe: Optional[int] = None) -> List[Document]:
+        """
+        Search several indexes concurrently and merge their results into a global top k.
+
+        Each index is searched like `search`, so scores aren't comparable across indexes (vector, fused and keyword
+        scores differ, and indexes may use different retrieval modes). Results are merged by rank instead: the first
+        result of every index, then the second ones, and so on, ties being broken by vector similarity. Each document
+        gets the "_index" it comes from and a "_normalized_score" in (0, 1], the reciprocal-rank score of its rank
+        relative to the first one.
+
+        :param timeout: Seconds to wait for all indexes. Indexes that haven't answered by then, or failed, are left out
+            of the results, so the latency is bounded by the timeout rather than the slowest index. Their searches are
+            cancelled if they haven't started yet.
+        """
+        executor = self._index_search_executor(index_names)
+        if executor is None:
+            return []
+        try:
+            futures = {executor.submit(self.search, query, top_k, index_name, nprobe): index_name
+                       for index_name in dict.fromkeys(index_names)}
+            done, not_done = wait(futures, timeout=timeout)
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+        return self._merge_indexes(futures, done, not_done, top_k, timeout)
+
+    async def asearch_indexes(self, query: str, index_names: List[str], top_k: int = 5,
+                              timeout: Optional[float] = None, nprobe: Optional[int] = None) -> List[Document]:
+        """
+        `search_indexes` for asyncio code. The backends, the keyword index and the snapshot reads are synchronous, so
+        this isn't async I/O: each index is still searched by the synchronous `search` on search threads, and only the
+        wait for them is awaited, which keeps the event loop free but uses a thread per index searched.
+        """
+        executor = self._index_search_executor(index_names)
+        if executor is None:
+            return []
+        loop = asyncio.get_running_loop()
+        try:
+            futures = {loop.run_in_executor(executor, self.search, query, top_k, index_name, nprobe): index_name
+                       for index_name in dict.fromkeys(index_names)}
+            done, not_done = await asyncio.wait(futures, timeout=timeout)
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+        return self._merge_indexes(futures, done, not_done, top_k, timeout)
+
+    def _index_search_executor(self, index_names: List[str]) -> Optional[ThreadPoolExecutor]:
+        """The threads searching the indexes of one `search_indexes` call, or None if there is no index to search.
+
+        Threads aren't shared between calls: a search can't be interrupted once it has started, so one that outlives
+        the timeout would keep holding a shared thread, and enough of them would leave later questions waiting for
+        threads until they time out too. Per call, a stuck search only holds its own thread until it returns.
+        """
+        workers = min(max(self.search_workers, 1), len(set(index_names)))
+        if workers <= 0:
+            return None
+        return ThreadPoolExecutor(max_workers=workers, thread_name_prefix="search")
+
+    @staticmethod
+    def _merge_indexes(futures: Dict[Any, str], done, not_done, top_k: int,
+                       timeout: Optional[float]) -> List[Document]:
+        """Merges the results of the searches of several indexes by rank (see `search_indexes`)."""
+        for future in not_done:
+            # Only searches that haven't started can be cancelled; running ones finish in the background.
+            future.cancel()
+            logger.warning(f"Search of index {futures[future]} timed out after {timeout}s; skipping it.")
+
+        ranked = []
+        for future in done:
+            try:
+                documents = future.result()
+            except Exception as e:
+                logger.error(f"Search of index {futures[future]} failed: {e}")
+                continue
+            for rank, doc in enumerate(documents):
+                doc.metadata["_index"] = futures[future]
+                doc.metadata["_normalized_score"] = (RRF_K + 1) / (RRF_K + rank + 1)
+                # Definitions found by name rank first; keyword-only hits have no vector similarity.
+                similarity = doc.metadata.get("_score", 1.0 if "_symbol" in doc.metadata else 0.0)
+                ranked.append((rank, -similarity, doc))
+        ranked.sort(key=lambda item: item[:2])
+        return [doc for _, _, doc in ranked[:top_k]]
+
+    def _find_definitions(self, index_name: str, query: str, top_k: int) -> List[Dict[str, Any]]:
+        """The chunks defining the identifiers in the query, looked up in the symbol table of the keyword index."""
+        if self.lexical_index is None:
+            return []
+        # Capitalized words come after the identifiers, and only match if something of that name is defined.
+        names = identifiers(query) + capitalized_words(query)
+        if not names:
+            return []
+        results = {}
+        for result in self.lexical_index.find_symbols(index_name, names, limit=top_k):
+            results.setdefault(result["_id"], result)
+        return list(results.values())
+
+    def _hybrid_search(self, index_name: str, query: str, top_k: int, nprobe: Optional[int]) -> List[Dict[str, Any]]:
+        """Searches the vector and keyword indexes concurrently, then merges their results by reciprocal-rank fusion.
+
+        Each hit gets an "_rrf_score"; vector hits keep their "_score" and keyword hits their "_bm25_score".
+        """
+        limit = top_k * self.hybrid_candidates
+        lexical = self._executor.submit(self.lexical_index.search, index_name, query, limit)
+        vector_results = self.backend.search(index_name, query=query, limit=limit, nprobe=nprobe)
+        fused = {}
+        for results in (vector_results, lexical.result()):
+            for rank, result in enumerate(results):
+                hit = fused.setdefault(result["_id"], result)
+                if hit is not result:
+                    # Found by both retrievers: keep the vector hit, with the keyword score too.
+                    hit.update({key: value for key, value in result.items() if key not in hit})
+                hit["_rrf_score"] = hit.get("_rrf_score", 0.0) + 1 / (RRF_K + rank + 1)
+        return sorted(fused.values(), key=lambda hit: hit["_rrf_score"], reverse=True)[:top_k]
+
     def index_exists(self, index_name: Optional[str] = None) -> bool:
         """
-        Check if the index exists in Marqo.
+        Check if the index exists in the vector store.
 
         :param index_name: The name of the index to check. If not provided, uses the default index_name.
         :return: True if the index exists, False otherwise.
         """
         index_name = index_name if index_name is not None else self.index_name
+        return self.backend.index_exists(index_name)
+
+    def delete_documents(self, ids: List[str], index_name: Optional[str] = None, batch_size: int = 128) -> None:
+        """
+        Delete documents from the index by ID.
+
+        :param ids: The IDs of the documents to delete. Unknown IDs are ignored.
+        :param index_name: The name of the index. If not provided, uses the default index_name.
+        :param batch_size: How many IDs are sent per request.
+        """
+        index_name = index_name if index_name is not None else self.index_name
+        for i in range(0, len(ids), batch_size):
+            self.backend.delete_documents(index_name, ids[i: i + batch_size])
+        if self.lexical_index is not None:
+            self.lexical_index.delete(index_name, ids)
 
-        try:
-            # Get the list of all indexes
-            indexes_info = self.client.get_indexes()
-            # Check if the provided index_name exists in the result
-            return any(index["indexName"] == index_name for index in indexes_info["results"])
-        except marqo.errors.MarqoError as e:
-            # If an error occurs when listing indexes, consider that the index doesn't exist
-            return False
     def delete_index(self, index_name: Optional[str] = None) -> None:
         """
-        Delete the index from Marqo.
+        Delete the index from the vector store.
 
         :param index_name: The name of the index to delete. If not provided, uses the default index_name.
         """
         index_name = index_name if index_name is not None else self.index_name
-        self.client.delete_index(index_name)
+        self.backend.delete_index(index_name)
+        if self.lexical_index is not None:
+            self.lexical_index.delete_index(index_name)
@@ -7,60 +7,151 @@ import pandas as pd
 import yaml
 from dotenv import load_dotenv
 
+from biz.context_packer import ContextPacker
+from biz.history_manager import HistoryManager
 from biz.llm.factory import Factory
+from biz.util.concurrency import ConcurrencyLimiter
 from biz.util.log import logger
+from biz.vector.factory import BackendFactory
+from biz.lexical_index import LexicalIndex
+from biz.repo_snapshot import RepoSnapshot
+from biz.retrieval_cache import IndexGenerations, RetrievalCache
+from biz.stream_coalescer import StreamCoalescer
 from biz.vector_store import VectorStore, Document
 
 load_dotenv("config/.env")
 
 client = Factory.getClient()
 
-marqo_base_url = os.getenv('MARQO_BASE_URL', 'http://localhost:8882')
-vector_store = VectorStore(url=marqo_base_url)
+# 只存储切片位置的索引，从本地代码仓库读取切片内容
+repo_snapshot = RepoSnapshot(os.getenv('LOCAL_REPOS_DIR', 'data/repos'))
+# 检索结果缓存：相同索引、相同问题直接返回缓存结果，索引更新（repos.json 中的 generation 变化）后自动失效；大小为 0 时不使用缓存
+retrieval_cache_max_mb = int(os.getenv('RETRIEVAL_CACHE_MAX_MB', 64))
+retrieval_cache = None
+if retrieval_cache_max_mb > 0:
+    retrieval_cache = RetrievalCache(max_bytes=retrieval_cache_max_mb * 1024 * 1024,
+                                     ttl_seconds=int(os.getenv('RETRIEVAL_CACHE_TTL_SECONDS', 600)))
+# 混合检索：建立了关键词索引的代码库同时进行向量检索和关键词（BM25）检索，按倒数排名融合（RRF）排序
+lexical_index = None
+if os.getenv('HYBRID_SEARCH', 'true').lower() == 'true':
+    lexical_index = LexicalIndex(os.getenv('LEXICAL_INDEX_DIR', 'data/lexical'))
+vector_store = VectorStore(backend=BackendFactory.getBackend(), snapshot=repo_snapshot, cache=retrieval_cache,
+                           generations=IndexGenerations("data/repos.json"), lexical_index=lexical_index)
 prompt_templates_file = "prompt_templates.yml"
 with open(prompt_templates_file, "r") as file:
     prompt_templates = yaml.safe_load(file)
     system_prompt_template = prompt_templates['system_prompt']
+    prefix_cache_system_prompt = prompt_templates['prefix_cache_system_prompt']
+    prefix_cache_user_prompt_template = prompt_templates['prefix_cache_user_prompt']
+    history_summary_prompt_template = prompt_templates['history_summary_prompt']
+    history_summary_template = prompt_templates['history_summary']
+# 提示词布局：prefix_cache 时 system prompt 固定、对话历史只追加、参考代码附在最后一条用户消息中，
+# 每轮对话的前缀与上一轮相同，可以命中 DeepSeek/OpenAI 的提示词缓存；legacy 时在最后一条用户消息前插入带参考代码的 system 消息
+prompt_layout = os.getenv('PROMPT_LAYOUT', 'prefix_cache')
+
+
+# 在下拉框中选择该项时搜索所有代码库
+ALL_INDEXES = "全部"
+# 同时搜索多个代码库时，每次搜索最多等待的时间（秒），超时的代码库不返回结果
+search_timeout = float(os.getenv('SEARCH_TIMEOUT_SECONDS', 5))
+# 每次提问检索的候选切片数；候选切片去重、合并同一文件中相邻的切片后，按相关度放入 prompt，直到用完 token 预算
+context_candidates = int(os.getenv('CONTEXT_CANDIDATES', 10))
+context_packer = ContextPacker(max_tokens=int(os.getenv('CONTEXT_MAX_TOKENS', 3000)), snapshot=repo_snapshot)
+# 同时处理的提问数上限（检索和生成），超出的提问排队等待；为 0 时不限制
+pipeline_limiter = ConcurrencyLimiter("chat", int(os.getenv('CHAT_MAX_CONCURRENCY', 64)))
+# 流式回复时合并模型返回的片段，每隔 STREAM_FLUSH_MS 毫秒或积累 STREAM_FLUSH_CHARS 个字符才刷新一次界面
+stream_coalescer = StreamCoalescer(interval_seconds=int(os.getenv('STREAM_FLUSH_MS', 50)) / 1000,
+                                   max_chars=int(os.getenv('STREAM_FLUSH_CHARS', 64)))
+# 机器人回复后附加的参考链接，不再发送给模型
+REFERENCES_HEADING = "\n\n**参考资料:**\n"
+
+
+async def summarize_history(summary, messages: list) -> str:
+    """把之前的摘要和之后的对话合并成新的摘要"""
+    conversation = "\n\n".join(
+        f"{'用户' if message['role'] == 'user' else '助手'}：{message['content']}" for message in messages)
+    prompt = history_summary_prompt_template.format(summary=summary or "无", conversation=conversation)
+    return await client.achat([{"role": "user", "content": prompt}])
+
+
+# 对话历史的 token 预算：最近的对话原样发送，超出预算的较早对话合并成摘要，
+# 每 HISTORY_SUMMARY_STEP 轮才更新一次摘要；为 0 时发送全部历史
+history_max_tokens = int(os.getenv('HISTORY_MAX_TOKENS', 4000))
+history_manager = None
+if history_max_tokens > 0:
+    history_manager = HistoryManager(summarize_history, max_tokens=history_max_tokens,
+                                     summary_step=int(os.getenv('HISTORY_SUMMARY_STEP', 4)), footer=REFERENCES_HEADING)
 
 
 # Function to fetch relevant documents
-def get_relevant_documents(messages: list, index_name=None):
+async def get_relevant_documents(messages: list, index_names=None):
     history_user_contents = [message["content"] for message in messages if message["role"] == "user"]
     query = " ".join(history_user_contents[-3:])
-    return vector_store.search(query=query, top_k=3, index_name=index_name)
+    documents = await vector_store.asearch_indexes(query=query, index_names=resolve_index_names(index_names),
+                                                   top_k=context_candidates, timeout=search_timeout)
+    return context_packer.pack(documents)
 
 
 # Function to generate system message with documents
 def create_system_message(documents: list):
-    ref_contents_str = [doc.page_content for doc in documents]
-    return system_prompt_template.format(ref_content=ref_contents_str)
-
-
-def chat_with_llm(messages: list, index_name: str, documents: List[Document]):
+    return system_prompt_template.format(ref_content=context_packer.format(documents))
+
+
+def build_messages(messages: list, documents: List[Document], summary: str = None) -> list:
+    """按 prompt_layout 组装发送给模型的消息，summary 为较早对话的摘要"""
+    # 删除掉role为system的消息，以及bot()预先追加的空白回复
+    messages = [message for message in messages if message["role"] != "system" and message.get("content")]
+
+    if prompt_layout == "prefix_cache":
+        # 只保留 role 和 content，历史消息的内容与上一轮请求中完全一致，前缀才能命中缓存
+        messages = [{"role": message["role"], "content": message["content"]} for message in messages]
+        if messages and messages[-1]["role"] == "user":
+            messages[-1]["content"] = prefix_cache_user_prompt_template.format(
+                ref_content=context_packer.format(documents), question=messages[-1]["content"])
+        system_message = prefix_cache_system_prompt
+        if summary:
+            # 摘要只在对话窗口移动时变化，放在固定的 system prompt 之后
+            system_message += "\n\n" + history_summary_template.format(summary=summary)
+        return [{"role": "system", "content": system_message}] + messages
+
+    # 把背景知识附加在system prompt里
+    system_message = create_system_message(documents)
+
+    # 在最后一个role=user消息后插入一个role=system消息
+    last_user_index = None
+    for i in range(len(messages) - 1, -1, -1):  # Start from the end
+        if messages[i]["role"] == "user":
+            last_user_index = i
+            break
+
+    if last_user_index is not None:
+        messages.insert(last_user_index, {"role": "system", "content": system_message})
+    if summary:
+        messages.insert(0, {"role": "system", "content": history_summary_template.format(summary=summary)})
+    return messages
+
+
+async def chat_with_llm(messages: list, index_names: List[str], documents: List[Document]):
     try:
-        # 删除掉role为system的消息
-        messages = [message for message in messages if message["role"] != "system"]
-
-        # 把背景知识附加在system prompt里
-        system_message = create_system_message(documents)
-
-        # 在最后一个role=user消息后插入一个role=system消息
-        last_user_index = None
-        for i in range(len(messages) - 1, -1, -1):  # Start from the end
-            if messages[i]["role"] == "user":
-                last_user_index = i
-                break
-
-        if last_user_index is not None:
-            messages.insert(last_user_index, {"role": "system", "content": system_message})
+        summary = None
+        if history_manager is not None:
+            summary, messages = await history_manager.prepare(messages)
+        messages = build_messages(messages, documents, summary)
 
         logger.info(f"向模型发送的消息: {messages}")
-        completions = client.chat_stream(messages)
+        completions = client.achat_stream(messages)
 
         # Stream response and yield chunks
-        for chunk in completions:
+        async for chunk in completions:
             chat_chunk = client.convert_to_chunk(chunk)
-            if chat_chunk.is_chunk() and chat_chunk.content:
+            if chat_chunk is None:
+                continue
+            if chat_chunk.is_usage():
+                usage = chat_chunk.usage
+                hit_rate = usage["cached_tokens"] / usage["prompt_tokens"] if usage["prompt_tokens"] else 0.0
+                logger.info(f"模型用量: 提示词 {usage['prompt_tokens']} tokens，其中命中缓存 {usage['cached_tokens']} "
+                            f"tokens（命中率 {hit_rate:.1%}），回复 {usage['completion_tokens']} tokens")
+            elif chat_chunk.is_chunk() and chat_chunk.content:
                 yield chat_chunk.content
 
     except Exception as e:
@@ -73,20 +164,23 @@ def user(user_message, history: list):
 
 
 # Bot response handler
-def bot(history: list, index_name=None):
+async def bot(history: list, index_names=None):
     """
     Call OpenAI API and return response.
     :param history: Conversation history
+    :param index_names: The selected indexes, possibly including ALL_INDEXES
     :return: Streaming response from the model
     """
     bot_message = ""
     history.append({"role": "assistant", "content": ""})
-    # 获取用户最后3条消息作为query，从marqo中搜索相关文档
-    documents = get_relevant_documents(messages=history, index_name=index_name)
-    for chunk in chat_with_llm(history, index_name=index_name, documents=documents):
-        bot_message += chunk
-        history[-1]['content'] = bot_message
-        yield history
+    async with pipeline_limiter.acquire():
+        # 获取用户最后3条消息作为query，从选中的代码库中并发搜索相关文档
+        documents = await get_relevant_documents(messages=history, index_names=index_names)
+        async for chunk in stream_coalescer.coalesce(
+                chat_with_llm(history, index_names=index_names, documents=documents)):
+            bot_message += chunk
+            history[-1]['content'] = bot_message
+            yield history
 
     # 机器人回复完成后，添加参考链接
     reference_links = {}
@@ -98,7 +192,7 @@ def bot(history: list, index_name=None):
             reference_links[url] = filename  # 以 URL 作为 Key，防止重复
 
     if reference_links:
-        reference_text = "\n\n**参考资料:**\n" + "\n".join(
+        reference_text = REFERENCES_HEADING + "\n".join(
             f"- [{filename}]({url})" for url, filename in reference_links.items()
         )
         history[-1]['content'] += reference_text  # 附加链接
@@ -119,22 +213,38 @@ def load_repos_to_df():
         return pd.DataFrame(), []
 
 
+def resolve_index_names(selected) -> List[str]:
+    """下拉框的选择（单个索引名或索引名列表）转换为索引名列表，选择了“全部”时返回所有可用索引。"""
+    if not selected:
+        return []
+    if isinstance(selected, str):
+        selected = [selected]
+    if ALL_INDEXES in selected:
+        return index_names
+    return selected
+
+
+df, repos = load_repos_to_df()
+# 增量更新中（或中断）的索引仍可使用上次完成的内容；从未完成过的索引不展示
+index_names = [repo['index_name'] for repo in repos if repo['index_status'] == 'done' or repo.get('commit')]
+
 with gr.Blocks() as app:
-    df, repos = load_repos_to_df()
-    index_names = [repo['index_name'] for repo in repos if repo['index_status'] == 'done']
 
     with gr.Tab("聊天"):
         chatbot = gr.Chatbot(type="messages")
         with gr.Row():
             with gr.Column(scale=1):
-                dropdown_index_name = gr.Dropdown(index_names, interactive=True, label="索引(代码库)")
+                dropdown_index_name = gr.Dropdown([ALL_INDEXES] + index_names, multiselect=True, interactive=True,
+                                                  label="索引(代码库)，可多选")
             with gr.Column(scale=4):
                 textbox_query = gr.Textbox(label="输入你的问题", placeholder="请输入...")
         with gr.Row():
             clear = gr.Button("清空对话")
 
             textbox_query.submit(user, [textbox_query, chatbot], [textbox_query, chatbot],
-                                 queue=False).then(bot, [chatbot, dropdown_index_name], chatbot)
+                                 queue=False).then(bot, [chatbot, dropdown_index_name], chatbot,
+                                                   # 并发数由 CHAT_MAX_CONCURRENCY 和各模型的并发上限控制
+                                                   concurrency_limit=None)
             clear.click(lambda: None, None, chatbot, queue=False)
     with gr.Tab("代码库"):
         gr.Markdown("代码库列表")
@@ -145,21 +255,52 @@ with gr.Blocks() as app:
     with gr.Tab("调试"):
         gr.Markdown("输入文本搜索向量库")
         json_data = gr.Json(label="返回结果")
+        cache_stats = gr.Json(label="检索缓存统计")
+
 
+        def similarity_search(index_names, top_k, query):
+            documents = vector_store.search_indexes(query=query, index_names=resolve_index_names(index_names),
+                                                    top_k=top_k, timeout=search_timeout)
+            stats = retrieval_cache.stats() if retrieval_cache is not None else None
+            return [{"metadata": doc.metadata, "page_content": doc.page_content} for doc in documents], stats
 
-        def similarity_search(index_name, top_k, query):
-            documents = vector_store.search(query=query, top_k=top_k, index_name=index_name)
-            return [{"metadata": doc.metadata, "page_content": doc.page_content} for doc in documents]
+
+        def batch_similarity_search(index_names, top_k, queries):
+            # 每行一个问题，在每个选中的索引中批量搜索，返回每个问题的结果和耗时
+            queries = [query.strip() for query in queries.splitlines() if query.strip()]
+            results = {}
+            for index_name in resolve_index_names(index_names):
+                results[index_name] = [
+                    {"query": result.query, "seconds": round(result.seconds, 4),
+                     "results": [{"metadata": doc.metadata, "page_content": doc.page_content}
+                                 for doc in result.documents]}
+                    for result in vector_store.search_many(queries, top_k=top_k, index_name=index_name)]
+            stats = retrieval_cache.stats() if retrieval_cache is not None else None
+            return results, stats
 
 
         with gr.Row():
             with gr.Column(scale=1):
-                debug_index_name = gr.Dropdown(index_names, interactive=True, label="选择索引")
+                debug_index_name = gr.Dropdown([ALL_INDEXES] + index_names, multiselect=True, interactive=True,
+                                               label="选择索引，可多选")
             with gr.Column(scale=1):
                 debug_top_k = gr.Dropdown([3, 5, 10, 20], interactive=True, label="返回结果数")
             with gr.Column(scale=4):
                 debug_query = gr.Textbox(label="输入文本, 按回车搜索向量库", placeholder="请输入...")
-                debug_query.submit(similarity_search, [debug_index_name, debug_top_k, debug_query], [json_data],
-                                   queue=False)
+                debug_query.submit(similarity_search, [debug_index_name, debug_top_k, debug_query],
+                                   [json_data, cache_stats], queue=False)
+        with gr.Row():
+            debug_queries = gr.Textbox(label="批量搜索：每行输入一个问题", lines=5, placeholder="请输入...")
+        with gr.Row():
+            batch_search = gr.Button("批量搜索")
+            batch_search.click(batch_similarity_search, [debug_index_name, debug_top_k, debug_queries],
+                               [json_data, cache_stats])
+        with gr.Row():
+            # 正在处理和排队等待的提问数、模型请求数
+            concurrency_stats = gr.Json(label="并发统计")
+        with gr.Row():
+            refresh_concurrency = gr.Button("刷新并发统计")
+            refresh_concurrency.click(lambda: [pipeline_limiter.stats(), client.limiter.stats()], None,
+                                      concurrency_stats, queue=False)
 
 app.launch(server_name="0.0.0.0", server_port=7860)
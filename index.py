@@ -6,7 +6,11 @@ from biz.repo_manager import RepositoryManager
 from dotenv import load_dotenv
 
 from biz.embedder import Embedder
+from biz.embedding_cache import EmbeddingCache
+from biz.index_manifest import IndexCheckpoint, IndexManifest
+from biz.lexical_index import LexicalIndex
 from biz.util.log import logger
+from biz.vector.factory import BackendFactory
 from biz.vector_store import VectorStore
 
 load_dotenv("config/.env")
@@ -24,16 +28,16 @@ def confirm_and_execute(config):
     return True
 
 
-def handle_existing_index(url, index_name):
-    vector_store = VectorStore(url=url, index_name=index_name)
+def handle_existing_index(vector_store, index_name):
     if vector_store.index_exists(index_name):
         logger.warning(f"警告：索引 '{index_name}' 已存在！")
         choice = input(
             "请选择操作：\n"
             "o. 覆盖索引\n"
             "i. 增量索引\n"
+            "r. 继续中断的索引\n"
             "e. 退出\n"
-            "请输入选择 (o/i/e): ").strip().lower()
+            "请输入选择 (o/i/r/e): ").strip().lower()
 
         if choice == 'o':
             logger.info(f"选择覆盖索引 '{index_name}'。")
@@ -41,6 +45,9 @@ def handle_existing_index(url, index_name):
         elif choice == 'i':
             logger.info(f"选择增量索引 '{index_name}'。")
             return 'increment'
+        elif choice == 'r':
+            logger.info(f"选择继续中断的索引 '{index_name}'。")
+            return 'resume'
         elif choice == 'e':
             logger.info("退出程序。")
             return 'exit'
@@ -50,8 +57,12 @@ def handle_existing_index(url, index_name):
     return None
 
 
-def add_repo_to_file(data_file_path, config):
-    """将新的仓库信息添加到指定的 JSON 文件中。如果 repo_id 已存在，则更新，否则添加。最终按照 index_name 排序。"""
+def add_repo_to_file(data_file_path, config, index_status="done", progress=None):
+    """将新的仓库信息添加到指定的 JSON 文件中。如果 repo_id 已存在，则更新，否则添加。最终按照 index_name 排序。
+
+    index_status 为 in_progress（索引中）、failed（索引中断）或 done（完成）；progress 为进度计数，如 indexed_files、total_files。
+    每次调用时索引都可能已变化，generation 加一，聊天服务缓存的该索引检索结果随之失效。
+    """
 
     # 检查文件是否存在或为空
     if not os.path.exists(data_file_path) or os.path.getsize(data_file_path) == 0:
@@ -72,15 +83,18 @@ def add_repo_to_file(data_file_path, config):
         if repo.get("repo_id") == repo_id:
             # 更新已存在的 repo 信息
             repo["index_name"] = config["index_name"]
-            repo["index_status"] = "done"
+            repo["index_status"] = index_status
             break
     else:
         # 如果 for 循环 未执行 break，说明 repo_id 不存在，添加新记录
-        repos.append({
+        repo = {
             "repo_id": repo_id,
             "index_name": config["index_name"],
-            "index_status": "done"
-        })
+            "index_status": index_status
+        }
+        repos.append(repo)
+    repo.update(progress or {})
+    repo["generation"] = repo.get("generation", 0) + 1
     # 按照 index_name 进行排序（升序）
     repos.sort(key=lambda x: x["index_name"])
 
@@ -114,7 +128,16 @@ config = {
     "local_repos_dir": os.getenv('LOCAL_REPOS_DIR', 'data/repos'),
     "gitlab_base_url": os.getenv('GITLAB_BASE_URL'),
     "tokens_per_chunk": int(os.getenv('TOKENS_PER_CHUNK', 800)),
+    "chunk_workers": int(os.getenv('CHUNK_WORKERS', 1)),
+    "vector_backend": os.getenv('VECTOR_BACKEND', 'marqo'),
     "marqo_base_url": os.getenv('MARQO_BASE_URL', 'http://localhost:8882'),
+    "local_vector_dir": os.getenv('LOCAL_VECTOR_DIR', 'data/vectors'),
+    "upload_workers": int(os.getenv('UPLOAD_WORKERS', 2)),
+    "embedding_cache_path": os.getenv('EMBEDDING_CACHE_PATH', 'data/embedding_cache.sqlite'),
+    "embedding_cache_max_mb": int(os.getenv('EMBEDDING_CACHE_MAX_MB', 0)),
+    "store_chunk_text": os.getenv('STORE_CHUNK_TEXT', 'true').lower() == 'true',
+    "hybrid_search": os.getenv('HYBRID_SEARCH', 'true').lower() == 'true',
+    "lexical_index_dir": os.getenv('LEXICAL_INDEX_DIR', 'data/lexical'),
     "ignore_file": os.getenv('IGNORE_FILE', "config/.ignore")
 }
 
@@ -123,20 +146,33 @@ if not confirm_and_execute(config):
     exit()
 
 # 检查索引是否存在
-action = handle_existing_index(config["marqo_base_url"], config["index_name"])
+backend = BackendFactory.getBackend(config["vector_backend"])
+# 关键词（BM25）索引，与向量索引同步更新，聊天时与向量检索混合排序
+lexical_index = LexicalIndex(config["lexical_index_dir"]) if config["hybrid_search"] else None
+vector_store = VectorStore(backend=backend, index_name=config["index_name"], lexical_index=lexical_index)
+action = handle_existing_index(vector_store, config["index_name"])
+manifest_path = os.path.join("data/manifests", f"{config['index_name']}.json")
 if action == 'exit':
     exit()
-elif action == 'increment':
-    # 增量索引，暂不支持
-    logger.info("增量索引暂不支持。")
-    exit()
+elif action in ('increment', 'resume'):
+    # 增量索引，只重新索引上次索引之后新增或修改的文件。继续中断的索引时，已上传完成的文件也会被跳过。
+    manifest = IndexManifest.load(manifest_path)
+    if manifest is None:
+        logger.error(f"找不到索引清单 '{manifest_path}'，无法增量索引，请选择覆盖索引。")
+        exit()
+    if action == 'resume' and manifest.status != 'in_progress':
+        logger.info("上次索引已完成，将执行增量索引。")
 elif action == 'overwrite':
     # 覆盖索引，删除原有索引
     logger.info(f"正在删除原有索引 '{config['index_name']}'...")
-    vector_store = VectorStore(url=config["marqo_base_url"], index_name=config["index_name"])
     vector_store.delete_index()
     logger.info(f"原有索引 '{config['index_name']}' 删除成功。")
 
+if action not in ('increment', 'resume'):
+    manifest = IndexManifest(manifest_path)
+elif lexical_index is not None and not lexical_index.exists(config["index_name"]):
+    logger.warning("该索引建立时未启用关键词索引，增量索引后关键词索引只包含本次更新的文件，如需完整的关键词索引请选择覆盖索引。")
+
 # 下载代码仓库
 repo_manager = RepositoryManager(
     repo_id=config["repo_id"],
@@ -151,17 +187,73 @@ logger.info(f"正在下载代码仓库 '{config['repo_id']}'...")
 repo_manager.download()
 logger.info(f"代码仓库 '{config['repo_id']}' 下载成功。")
 
+# 对比索引清单和当前提交，找出需要重新索引的文件
+commit = repo_manager.head_commit()
+blobs = repo_manager.file_blobs()
+changed_files, deleted_files = manifest.diff(blobs)
+if action in ('increment', 'resume'):
+    logger.info(f"增量索引: {manifest.commit} -> {commit}，新增或修改 {len(changed_files)} 个文件，"
+                f"删除 {len(deleted_files)} 个文件。")
+    if not changed_files and not deleted_files:
+        logger.info("索引已是最新，无需更新。")
+        manifest.update(commit, blobs, {}, changed=set())
+        manifest.save()
+        exit()
+
 chunker = UniversalFileChunker(max_tokens=config["tokens_per_chunk"])
 
+# 嵌入缓存：相同模型下相同文本的切片直接复用已计算的向量（所有索引共享），大小为 0 时不使用缓存
+embedding_cache = None
+if config["embedding_cache_max_mb"] > 0:
+    embedding_cache = EmbeddingCache(config["embedding_cache_path"],
+                                     max_bytes=config["embedding_cache_max_mb"] * 1024 * 1024)
+
 # 初始化 embedder，确保使用配置中的参数
 embedder = Embedder(
     repo_manager=repo_manager,
     chunker=chunker,
     index_name=config["index_name"],
-    url=config["marqo_base_url"]
+    backend=backend,
+    chunk_workers=config["chunk_workers"],
+    upload_workers=config["upload_workers"],
+    embedding_cache=embedding_cache,
+    store_text=config["store_chunk_text"],
+    lexical_index=lexical_index
 )
 
-# 执行嵌入数据集操作，确保 chunks_per_batch 从 config 中传递
-embedder.embed_dataset()
+total_files = sum(1 for _ in repo_manager.walk(get_content=False, only_paths=changed_files))
+
+
+def report_progress(indexed_files, total_files):
+    add_repo_to_file(data_file_path="data/repos.json", config=config, index_status="in_progress",
+                     progress={"indexed_files": indexed_files, "total_files": total_files})
+
+
+# 每个文件上传完成后记入清单并定期保存，中断后可选择继续索引
+checkpoint = IndexCheckpoint(manifest, blobs, total_files=total_files, on_save=report_progress)
+checkpoint.save()
+
+# 只对新增或修改的文件执行嵌入（新建或覆盖索引时即所有文件）
+try:
+    # 有切片被向量库拒绝的文件记为未完成，下次运行时重新索引
+    file_chunk_ids, incomplete_files = embedder.embed_dataset(file_paths=changed_files, on_file_indexed=checkpoint)
+except BaseException:
+    checkpoint.save()
+    add_repo_to_file(data_file_path="data/repos.json", config=config, index_status="failed",
+                     progress={"indexed_files": checkpoint.indexed_files, "total_files": total_files})
+    logger.error("索引中断，已保存进度。重新运行并选择 'r' 可继续索引。")
+    raise
+
+manifest.update(commit, blobs, file_chunk_ids, changed=changed_files, deleted=deleted_files,
+                incomplete=incomplete_files)
+
+# 删除已删除或已修改文件的旧切片（包括之前中断的索引留下的）。新切片可能与旧切片 ID 相同（已被覆盖），不会删除。
+stale_chunk_ids = manifest.stale_ids()
+if stale_chunk_ids:
+    logger.info(f"正在删除 {len(stale_chunk_ids)} 个过期切片...")
+    vector_store.delete_documents(stale_chunk_ids)
+manifest.stale_chunk_ids = []
+manifest.save()
 
-add_repo_to_file(data_file_path="data/repos.json", config=config)
+add_repo_to_file(data_file_path="data/repos.json", config=config,
+                 progress={"indexed_files": total_files, "total_files": total_files, "commit": commit})
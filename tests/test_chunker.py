@@ -0,0 +1,26 @@
+from biz.chunker import ChunkedFile, UniversalFileChunker
+
+
+def test_chunk_ids_of_non_ascii_paths_are_distinct():
+    chunker = UniversalFileChunker(200)
+    content = "def main():\n    return 1\n"
+    data_chunks = chunker.chunk(content, {"file_path": "org/repo/数据.py"})
+    config_chunks = chunker.chunk(content, {"file_path": "org/repo/配置.py"})
+
+    data_ids = {chunk.id for chunk in data_chunks}
+    config_ids = {chunk.id for chunk in config_chunks}
+
+    assert data_ids and config_ids
+    assert not data_ids & config_ids
+    for chunk in list(data_chunks) + list(config_chunks):
+        assert chunk.id.isascii()
+        assert chunk.metadata["_id"] == chunk.id
+
+
+def test_chunk_ids_of_ascii_paths_are_unchanged():
+    chunks = ChunkedFile(b"x = 1\n", {"file_path": "org/repo/src/main.py"})
+    chunks.starts.append(0)
+    chunks.ends.append(6)
+    chunks.tokens.append(3)
+
+    assert chunks[0].id == "org/repo/src/main.py_0_6"
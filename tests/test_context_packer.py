@@ -0,0 +1,29 @@
+from biz.context_packer import ContextPacker
+from biz.vector_store import Document
+
+SOURCE = "def first():\n    return 1\n\ndef second():\n    return 2\n"
+
+
+def _chunk(text: str) -> Document:
+    start = SOURCE.index(text)
+    metadata = {"file_path": "org/repo/main.py", "_index": "repo", "start_byte": start, "end_byte": start + len(text)}
+    return Document(page_content=f"org/repo/main.py\n\n{text}", metadata=metadata)
+
+
+def test_chunks_separated_by_a_blank_line_are_merged():
+    first = _chunk("def first():\n    return 1")
+    second = _chunk("def second():\n    return 2")
+
+    merged = ContextPacker().merge([second, first])
+
+    assert len(merged) == 1
+    assert merged[0].metadata["start_byte"] == first.metadata["start_byte"]
+    assert merged[0].metadata["end_byte"] == second.metadata["end_byte"]
+    assert merged[0].page_content == "org/repo/main.py\n\ndef first():\n    return 1\ndef second():\n    return 2"
+
+
+def test_distant_chunks_are_kept_apart():
+    first = _chunk("def first():\n    return 1")
+    second = _chunk("def second():\n    return 2")
+
+    assert len(ContextPacker(max_gap_bytes=1).merge([first, second])) == 2
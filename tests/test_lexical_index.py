@@ -0,0 +1,24 @@
+from biz.lexical_index import LexicalIndex, capitalized_words, identifiers
+from biz.vector_store import VectorStore
+
+
+def test_identifiers_starting_with_an_acronym():
+    assert identifiers("JSONDecoder 报错了") == ["JSONDecoder"]
+    assert identifiers("HTTPServer 和 XMLParser 在哪里定义") == ["HTTPServer", "XMLParser"]
+
+
+def test_capitalized_words_are_not_identifiers():
+    question = "How do I run Docker with Embedder?"
+    assert identifiers(question) == []
+    assert capitalized_words(question) == ["How", "Docker", "Embedder"]
+
+
+def test_capitalized_words_only_match_defined_symbols(tmp_path):
+    lexical_index = LexicalIndex(str(tmp_path))
+    document = {"_id": "1", "file_path": "biz/embedder.py"}
+    lexical_index.add("repo", [document], ["class Embedder:"], symbols=[[("Embedder", "class", 0, 15)]])
+    vector_store = VectorStore(backend=None, lexical_index=lexical_index)
+
+    definitions = vector_store._find_definitions("repo", "How does Docker call Embedder?", top_k=3)
+
+    assert [definition["_symbol"]["name"] for definition in definitions] == ["Embedder"]
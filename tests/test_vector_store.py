@@ -0,0 +1,56 @@
+import asyncio
+import threading
+import time
+
+from biz.vector.backend.base import BaseBackend
+from biz.vector_store import VectorStore
+
+
+class StuckBackend(BaseBackend):
+    """Answers immediately, except for the "stuck" index, whose searches block until released."""
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.searched = []
+
+    def search(self, index_name, query, limit, nprobe=None):
+        self.searched.append(index_name)
+        if index_name == "stuck":
+            self.release.wait(5)
+        return [{"_id": f"{index_name}_0", "text": f"{index_name}/a.py\n\ncode", "file_path": f"{index_name}/a.py",
+                 "_score": 0.5}]
+
+
+def test_timed_out_searches_do_not_hold_threads_of_later_searches():
+    backend = StuckBackend()
+    store = VectorStore(backend, search_workers=1)
+    try:
+        start = time.perf_counter()
+        first = store.search_indexes("query", ["stuck", "other"], timeout=0.2)
+        second = store.search_indexes("query", ["fast"], timeout=1)
+        assert time.perf_counter() - start < 1
+    finally:
+        backend.release.set()
+
+    assert first == []
+    # The search of "other" was queued behind the stuck one, and cancelled when the call timed out.
+    assert "other" not in backend.searched
+    assert [doc.metadata["_index"] for doc in second] == ["fast"]
+
+
+def test_async_timed_out_searches_do_not_hold_threads_of_later_searches():
+    backend = StuckBackend()
+    store = VectorStore(backend, search_workers=1)
+
+    async def search():
+        first = await store.asearch_indexes("query", ["stuck"], timeout=0.2)
+        second = await store.asearch_indexes("query", ["fast"], timeout=1)
+        return first, second
+
+    try:
+        first, second = asyncio.run(search())
+    finally:
+        backend.release.set()
+
+    assert first == []
+    assert [doc.metadata["_index"] for doc in second] == ["fast"]